@@ -2,71 +2,158 @@
 Точка входа для запуска RAG бота.
 """
 
+import asyncio
 import logging
+import logging.handlers
+import queue
 import sys
-import socket
 from telegram import Update
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters
 )
 
 from rag_bot import RAGBot, config
+from rag_bot.network import create_http_transport
 
-# Принудительно используем IPv4 вместо IPv6 для решения проблем с SSL
-# Это исправляет проблему с таймаутами при подключении к Telegram API
-original_getaddrinfo = socket.getaddrinfo
+# uvloop - более быстрый event loop на libuv (недоступен на Windows)
+if sys.platform != "win32":
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+else:
+    uvloop = None
 
-def getaddrinfo_ipv4(*args, **kwargs):
-    """Переопределяем getaddrinfo для использования только IPv4."""
-    responses = original_getaddrinfo(*args, **kwargs)
-    # Фильтруем только IPv4 адреса
-    return [r for r in responses if r[0] == socket.AF_INET]
+# Настройка логирования: обработчики пишут в очередь, а вывод в консоль
+# выполняет отдельный поток QueueListener, поэтому запись логов не блокирует event loop
+log_queue = queue.Queue(-1)
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+)
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler, respect_handler_level=True)
+log_listener.start()
 
-socket.getaddrinfo = getaddrinfo_ipv4
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
+# Типы обновлений, которые нужны боту (все обработчики работают с сообщениями).
+# Остальные (callback_query, edited_channel_post и т.п.) Telegram не будет присылать вовсе.
+ALLOWED_UPDATES = [Update.MESSAGE]
+
 
 def main():
     """Основная функция для запуска бота."""
     # Проверяем, что токен загружен
     if not config.TELEGRAM_BOT_TOKEN or config.TELEGRAM_BOT_TOKEN == "your_telegram_bot_token_here":
-        print("❌ Ошибка: TELEGRAM_BOT_TOKEN не установлен или имеет значение по умолчанию!")
-        print("Пожалуйста, проверьте файл .env и убедитесь, что токен установлен правильно.")
+        logger.error(
+            "❌ TELEGRAM_BOT_TOKEN не установлен или имеет значение по умолчанию! "
+            "Пожалуйста, проверьте файл .env и убедитесь, что токен установлен правильно."
+        )
+        log_listener.stop()
         sys.exit(1)
     
     if not config.GROQ_API_KEY or config.GROQ_API_KEY == "your_groq_api_key_here":
-        print("❌ Ошибка: GROQ_API_KEY не установлен или имеет значение по умолчанию!")
-        print("Пожалуйста, проверьте файл .env и убедитесь, что API ключ установлен правильно.")
+        logger.error(
+            "❌ GROQ_API_KEY не установлен или имеет значение по умолчанию! "
+            "Пожалуйста, проверьте файл .env и убедитесь, что API ключ установлен правильно."
+        )
+        log_listener.stop()
+        sys.exit(1)
+    
+    if config.BOT_ROLE not in ("standalone", "ingress", "worker"):
+        logger.error(f"❌ Неизвестная роль BOT_ROLE={config.BOT_ROLE}. Допустимо: standalone, ingress, worker.")
+        log_listener.stop()
+        sys.exit(1)
+    
+    if config.BOT_ROLE == "ingress" and not (config.WEBHOOK_URL and config.WEBHOOK_SECRET):
+        logger.error(
+            "❌ Для роли ingress нужны WEBHOOK_URL и TG_WEBHOOK_SECRET! "
+            "Укажите их в файле .env."
+        )
+        log_listener.stop()
+        sys.exit(1)
+    
+    if config.REDIS_SHARDS < 1 or not 0 <= config.WORKER_SHARD < config.REDIS_SHARDS:
+        logger.error(
+            f"❌ Некорректное шардирование: REDIS_SHARDS={config.REDIS_SHARDS}, WORKER_SHARD={config.WORKER_SHARD}. "
+            "Нужно REDIS_SHARDS >= 1 и 0 <= WORKER_SHARD < REDIS_SHARDS."
+        )
+        log_listener.stop()
+        sys.exit(1)
+    
+    if config.USE_WEBHOOK and not config.WEBHOOK_URL:
+        logger.error(
+            "❌ USE_WEBHOOK включен, но WEBHOOK_URL не установлен! "
+            "Укажите публичный HTTPS адрес бота в файле .env или отключите USE_WEBHOOK для режима polling."
+        )
+        log_listener.stop()
         sys.exit(1)
     
-    print("🚀 Инициализация бота...")
-    print(f"📝 Токен бота: {config.TELEGRAM_BOT_TOKEN[:10]}...{config.TELEGRAM_BOT_TOKEN[-5:]}")
+    logger.info("🚀 Инициализация бота...")
+    logger.info(f"📝 Токен бота: {config.TELEGRAM_BOT_TOKEN[:10]}...{config.TELEGRAM_BOT_TOKEN[-5:]}")
+    
+    if config.BOT_ROLE == "ingress":
+        # Ingress только складывает обновления в Redis Stream:
+        # модель эмбеддингов и RAGBot этому процессу не нужны
+        from rag_bot.update_queue import run_ingress
+        try:
+            run_ingress(ALLOWED_UPDATES)
+        finally:
+            log_listener.stop()
+        return
+    
+    # Используем uvloop, если он установлен. Политику нужно установить до создания
+    # event loop, который PTB получает при запуске webhook/polling
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Используется uvloop")
     
     # Создаем экземпляр бота
     rag_bot = RAGBot()
     
-    # Проверяем доступность Telegram API перед запуском
-    print("🔍 Проверка доступности Telegram API...")
-    print("💡 Примечание: Если проверка не проходит, бот все равно попытается подключиться")
-    
     # Создаем приложение Telegram с правильной конфигурацией
     # Используем стандартные настройки - они должны работать лучше
-    application = (
+    # HTTP/2 с пулом соединений: параллельные запросы к Bot API идут по уже открытым соединениям.
+    # IPv4 (FORCE_IPV4) задается на уровне транспорта, без подмены socket.getaddrinfo
+    bot_request = HTTPXRequest(
+        connection_pool_size=config.HTTP_MAX_CONNECTIONS,
+        http_version="2",
+        httpx_kwargs={"transport": create_http_transport(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_KEEPALIVE_CONNECTIONS
+        )}
+    )
+    # Отдельное соединение для long-polling запросов getUpdates
+    get_updates_request = HTTPXRequest(
+        connection_pool_size=1,
+        http_version="2",
+        httpx_kwargs={"transport": create_http_transport(max_connections=1, max_keepalive_connections=1)}
+    )
+    
+    builder = (
         Application.builder()
         .token(config.TELEGRAM_BOT_TOKEN)
+        .request(bot_request)
         .concurrent_updates(True)  # Разрешаем параллельную обработку обновлений
-        .build()
+        .post_init(rag_bot.post_init)  # Фоновая загрузка модели эмбеддингов
+        .post_shutdown(rag_bot.shutdown)  # Закрываем HTTP клиент и пул потоков бота
     )
+    if config.BOT_ROLE == "worker":
+        # Обновления приходят из Redis Stream, собственный Updater не нужен
+        builder = builder.updater(None)
+    else:
+        builder = builder.get_updates_request(get_updates_request)
+    application = builder.build()
     
     # Добавляем обработчик ошибок
     async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -80,20 +167,19 @@ def main():
             except:
                 pass
     
-    # Добавляем обработчик всех обновлений для логирования
+    # Трассировка входящих обновлений нужна только при отладке,
+    # поэтому обработчик регистрируется лишь при уровне DEBUG
     async def log_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Логируем все входящие обновления."""
+        """Логируем входящие обновления (только при уровне DEBUG)."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         user_id = update.effective_user.id if update.effective_user else "unknown"
         if update.message:
             text_preview = update.message.text[:50] if update.message.text else 'файл/медиа'
-            print(f"📨 Получено сообщение от пользователя {user_id}: {text_preview}")
-            logger.info(f"📨 Получено сообщение от {user_id}: {text_preview}")
-        elif update.callback_query:
-            print(f"🔘 Получен callback от пользователя {user_id}")
-            logger.info(f"🔘 Получен callback от {user_id}")
+            logger.debug(f"📨 Получено сообщение от {user_id}: {text_preview}")
     
-    # Регистрируем обработчик для логирования (с низким приоритетом)
-    application.add_handler(MessageHandler(filters.ALL, log_update), group=-1)
+    if logger.isEnabledFor(logging.DEBUG):
+        application.add_handler(TypeHandler(Update, log_update), group=-1)
     
     # Регистрируем обработчики команд
     application.add_handler(CommandHandler("start", rag_bot.start_command))
@@ -109,56 +195,66 @@ def main():
     # Регистрируем обработчик ошибок
     application.add_error_handler(error_handler)
     
-    # Проверка токена будет выполнена автоматически при запуске polling
+    # Проверка токена будет выполнена автоматически при запуске webhook/polling
     
     # Запускаем бота
-    logger.info("Бот запущен и готов к работе!")
-    print("✅ Бот успешно запущен и готов к работе!")
-    print("💡 Отправьте команду /start боту в Telegram")
-    print("💡 Нажмите Ctrl+C для остановки бота.")
-    print("-" * 50)
-    print("📡 Ожидание подключения к Telegram API...")
-    print("   (Это может занять несколько секунд)")
-    print("-" * 50)
+    logger.info("✅ Бот запущен и готов к работе! Отправьте команду /start боту в Telegram, Ctrl+C - остановка.")
     
     try:
-        # Запускаем polling - стандартный подход
-        logger.info("Начинаю polling...")
-        print("🔄 Подключение к Telegram API...")
-        print("💡 Это может занять до 2 минут при проблемах с сетью...")
-        
-        # Используем стандартный run_polling - он лучше обрабатывает сетевые проблемы
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True,
-            close_loop=False
-        )
+        if config.BOT_ROLE == "worker":
+            # Воркер: обновления читаются из Redis Stream, который наполняет ingress
+            from rag_bot.update_queue import run_worker
+            asyncio.run(run_worker(application, rag_bot))
+        elif config.USE_WEBHOOK:
+            # Webhook: Telegram сам присылает обновления через reverse proxy,
+            # run_webhook регистрирует webhook_url и поднимает HTTP сервер
+            logger.info(
+                f"🌐 Запускаю webhook на {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT} "
+                f"({config.WEBHOOK_URL}/<token>)..."
+            )
+            application.run_webhook(
+                listen=config.WEBHOOK_LISTEN,
+                port=config.WEBHOOK_PORT,
+                url_path=config.TELEGRAM_BOT_TOKEN,
+                webhook_url=f"{config.WEBHOOK_URL}/{config.TELEGRAM_BOT_TOKEN}",
+                secret_token=config.WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=True,
+                close_loop=False
+            )
+        else:
+            # Запускаем polling - режим для разработки
+            logger.info("🔄 Начинаю polling (подключение может занять до 2 минут при проблемах с сетью)...")
+            
+            application.run_polling(
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=True,
+                close_loop=False
+            )
     except KeyboardInterrupt:
-        logger.info("Получен сигнал прерывания (Ctrl+C). Останавливаю бота...")
-        print("\n⏹️  Остановка бота...")
+        logger.info("⏹️ Получен сигнал прерывания (Ctrl+C). Останавливаю бота...")
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"Критическая ошибка при работе бота: {e}", exc_info=True)
         
         # Игнорируем ошибки при остановке
         if "AsyncLibraryNotFoundError" in error_msg or "no running event loop" in error_msg:
-            print("\n⚠️  Ошибка при остановке бота (не критично)")
-            print("Бот был остановлен пользователем")
+            logger.warning("⚠️ Ошибка при остановке бота (не критично): бот был остановлен пользователем")
         elif "Unauthorized" in error_msg or "401" in error_msg:
-            print(f"❌ Ошибка авторизации: Неправильный токен бота!")
-            print("Проверьте токен в файле .env")
+            logger.error("❌ Ошибка авторизации: неправильный токен бота! Проверьте токен в файле .env")
         elif "Timed out" in error_msg or "timeout" in error_msg.lower() or "ConnectTimeout" in error_msg:
-            print(f"⚠️  Таймаут при подключении к Telegram API")
-            print("\n💡 Возможные решения:")
-            print("   1. Проверьте интернет-соединение")
-            print("   2. Попробуйте перезапустить бота через несколько минут")
-            print("   3. Проверьте, работает ли Telegram на вашем компьютере")
-            print("   4. Если используете корпоративную сеть/VPN - проверьте настройки")
-            print("   5. Попробуйте использовать другой DNS (например, 8.8.8.8)")
+            logger.error(
+                "⚠️ Таймаут при подключении к Telegram API. Возможные решения:\n"
+                "   1. Проверьте интернет-соединение\n"
+                "   2. Попробуйте перезапустить бота через несколько минут\n"
+                "   3. Проверьте, работает ли Telegram на вашем компьютере\n"
+                "   4. Если используете корпоративную сеть/VPN - проверьте настройки\n"
+                "   5. Попробуйте использовать другой DNS (например, 8.8.8.8)"
+            )
         else:
-            print(f"❌ Критическая ошибка: {e}")
+            logger.error(f"❌ Критическая ошибка при работе бота: {e}", exc_info=True)
     finally:
-        print("👋 Бот остановлен. До свидания!")
+        logger.info("👋 Бот остановлен. До свидания!")
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -2,10 +2,23 @@
 RAG Bot - Модуль для Telegram бота с RAG функциональностью.
 """
 
-from .bot import RAGBot
-from .document_processor import DocumentProcessor
-from .vector_store import VectorStore
-from . import config
+import importlib
 
 __all__ = ['RAGBot', 'DocumentProcessor', 'VectorStore', 'config']
 
+# Модуль, в котором определено каждое имя пакета.
+# Импорт ленивый: дочерние процессы пула извлечения текста (spawn) импортируют пакет
+# и не должны загружать torch, ChromaDB и конфигурацию бота
+_EXPORTS = {
+    'RAGBot': '.bot',
+    'DocumentProcessor': '.document_processor',
+    'VectorStore': '.vector_store',
+    'config': '.config',
+}
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_EXPORTS[name], __name__)
+    return module if name == 'config' else getattr(module, name)
@@ -4,9 +4,19 @@
 """
 
 import os
+import time
+import asyncio
 import logging
-from typing import Dict
-from telegram import Update
+import functools
+import itertools
+from io import BytesIO
+from datetime import timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Tuple
+import httpx
+from telegram import Message, Update
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -19,16 +29,29 @@ from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 
 # Импортируем наши модули
 from . import config
-from .document_processor import DocumentProcessor
+from .disk_cache import prune_cache
+from .document_processor import DocumentProcessor, file_hash
+from .network import create_http_transport
 from .vector_store import VectorStore
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
+# Минимальный объем текста документа (в символах без пробелов по краям)
+MIN_TEXT_LENGTH = 50
+
+# Инструкции для LLM не зависят от запроса, поэтому сообщение создается один раз.
+# Контекст из документов передается отдельным системным сообщением
+INSTRUCTION_MSG = SystemMessage(content=(
+    "Ты - полезный AI-ассистент, который отвечает на вопросы пользователей "
+    "на основе предоставленного контекста из документов.\n\n"
+    "Инструкции:\n"
+    "1. Отвечай ТОЛЬКО на основе предоставленного контекста\n"
+    "2. Если в контексте нет информации для ответа, честно скажи об этом\n"
+    "3. Отвечай на русском языке\n"
+    "4. Будь точным и информативным\n"
+    "5. Используй контекст предыдущих сообщений для лучшего понимания"
+))
+
 
 class RAGBot:
     """
@@ -39,27 +62,104 @@ class RAGBot:
     def __init__(self):
         """Инициализация бота."""
         # Инициализируем компоненты
-        self.document_processor = DocumentProcessor()
+        self.document_processor = DocumentProcessor(cache_dir=config.DOCUMENT_CACHE_DIR)
         self.vector_store = VectorStore(
             db_path=config.CHROMA_DB_PATH,
-            embedding_model=config.EMBEDDING_MODEL
+            embedding_model=config.EMBEDDING_MODEL,
+            batch_size=config.EMBED_BATCH_SIZE,
+            onnx_model_path=config.EMBEDDING_ONNX_PATH,
+            ingest_batch_size=config.INGEST_BATCH_SIZE,
+            cache_dir=config.DOCUMENT_CACHE_DIR
+        )
+        self._prune_document_cache()
+        
+        # Общий HTTP/2 клиент для запросов к Groq: соединение (TCP + TLS)
+        # переиспользуется между запросами, параллельные запросы мультиплексируются
+        self.http_client = httpx.AsyncClient(
+            transport=create_http_transport(
+                max_connections=config.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=config.HTTP_KEEPALIVE_CONNECTIONS
+            ),
+            timeout=httpx.Timeout(60.0, connect=5.0)
         )
         
         # Инициализируем LLM от Groq
         self.llm = ChatGroq(
             groq_api_key=config.GROQ_API_KEY,
             model_name=config.GROQ_MODEL,
-            temperature=0.7
+            temperature=0.7,
+            streaming=True,
+            http_async_client=self.http_client
         )
         
-        # Словарь для хранения памяти диалогов по пользователям
-        # Каждый пользователь имеет свою память (список сообщений)
-        self.memories: Dict[int, list] = {}
+        # Память диалогов по пользователям (LRU: при переполнении вытесняются
+        # давно неактивные пользователи). Каждый пользователь имеет свою память -
+        # очередь последних сообщений ограниченной длины
+        self.memories: "OrderedDict[int, Deque]" = OrderedDict()
         
-        # Временное хранилище для загружаемых файлов
-        self.temp_files: Dict[int, str] = {}
+        # Пул потоков для блокирующей обработки документов (парсинг, эмбеддинги, ChromaDB)
+        self._io_pool = ThreadPoolExecutor(
+            max_workers=config.INGEST_WORKERS,
+            thread_name_prefix="rag-io"
+        )
+        
+        # Ограничиваем число одновременно обрабатываемых документов,
+        # чтобы модель эмбеддингов не исчерпала память
+        self._ingest_semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_INGESTIONS)
+    
+    async def post_init(self, application: Application) -> None:
+        """
+        Вызывается после инициализации приложения: загружает модель эмбеддингов
+        в фоновом потоке, не задерживая запуск бота.
+        
+        Args:
+            application: Приложение Telegram
+        """
+        application.create_task(asyncio.to_thread(self.vector_store.load_embedding_model))
+    
+    async def shutdown(self, application: Application) -> None:
+        """
+        Освобождает ресурсы бота при остановке приложения (HTTP клиент, пул потоков).
+        
+        Args:
+            application: Приложение Telegram
+        """
+        await self.http_client.aclose()
+        self._io_pool.shutdown(wait=False)
     
-    def get_memory(self, user_id: int) -> list:
+    async def _run_blocking(self, func, *args, **kwargs):
+        """
+        Выполняет блокирующую функцию в пуле потоков, не блокируя event loop.
+        
+        Args:
+            func: Блокирующая функция
+            *args, **kwargs: Аргументы функции
+            
+        Returns:
+            Результат выполнения функции
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_pool, functools.partial(func, *args, **kwargs))
+    
+    async def _safe_edit_text(self, message: Message, text: str) -> None:
+        """
+        Редактирует сообщение с учетом ограничения Telegram на частоту запросов.
+        При RetryAfter ждет указанное время и повторяет попытку.
+        
+        Args:
+            message: Сообщение для редактирования
+            text: Новый текст сообщения
+        """
+        try:
+            await message.edit_text(text)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            await asyncio.sleep(retry_after)
+            await message.edit_text(text)
+    
+    def get_memory(self, user_id: int) -> Deque:
         """
         Получает историю диалога для пользователя.
         
@@ -67,10 +167,14 @@ class RAGBot:
             user_id: ID пользователя Telegram
             
         Returns:
-            Список сообщений (история диалога)
+            Очередь сообщений (история диалога), старые сообщения вытесняются автоматически
         """
-        if user_id not in self.memories:
-            self.memories[user_id] = []
+        if user_id in self.memories:
+            self.memories.move_to_end(user_id)
+        else:
+            self.memories[user_id] = deque(maxlen=config.HISTORY_LEN)
+            if len(self.memories) > config.MAX_ACTIVE_USERS:
+                self.memories.popitem(last=False)
         return self.memories[user_id]
     
     def clear_memory(self, user_id: int) -> None:
@@ -90,7 +194,6 @@ class RAGBot:
         """
         try:
             user_id = update.effective_user.id
-            print(f"✅ Обработчик /start вызван для пользователя {user_id}")
             logger.info(f"🔵 Обработчик /start вызван для пользователя {user_id}")
             
             welcome_message = (
@@ -137,25 +240,87 @@ class RAGBot:
         """
         user_id = update.effective_user.id
         
-        # Очищаем векторную базу данных
-        self.vector_store.clear_user_collection(user_id)
+        # Очищаем векторную базу данных, кэш эмбеддингов и дисковый кэш документов пользователя
+        await self._run_blocking(self.vector_store.clear_user_collection, user_id)
         
         # Очищаем память диалога
         self.clear_memory(user_id)
         
-        # Удаляем временные файлы
-        if user_id in self.temp_files:
-            temp_file = self.temp_files[user_id]
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-            del self.temp_files[user_id]
-        
         await update.message.reply_text(
             "✅ Все документы и память диалога очищены. "
             "Вы можете загрузить новые документы."
         )
         logger.info(f"Пользователь {user_id} очистил данные")
     
+    def _ingest_document(self, user_id: int, file_buffer: BytesIO, file_ext: str, file_name: str) -> Tuple[int, int]:
+        """
+        Загружает документ потоком: части текста -> чанки -> минибатчи в векторную БД.
+        Весь текст документа в памяти не собирается.
+        Блокирующий вызов: выполняется в пуле потоков через _run_blocking.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            file_buffer: Содержимое файла
+            file_ext: Расширение файла
+            file_name: Имя файла (сохраняется в метаданных чанков)
+            
+        Returns:
+            Количество извлеченных символов и количество чанков
+            (0 чанков, если текста меньше MIN_TEXT_LENGTH - старый документ тогда не трогается)
+        """
+        doc_hash = file_hash(file_buffer)
+        parts = self.document_processor.iter_text(file_buffer, file_ext, doc_hash, user_id)
+        
+        # Читаем начало документа, пока не наберется минимум текста:
+        # слишком короткий документ отклоняется до замены старого
+        head = []
+        head_len = 0
+        for part in parts:
+            head.append(part)
+            head_len += len(part.strip())
+            if head_len >= MIN_TEXT_LENGTH:
+                break
+        if head_len < MIN_TEXT_LENGTH:
+            return head_len, 0
+        
+        n_chars = 0
+        
+        def counted(stream):
+            nonlocal n_chars
+            for part in stream:
+                n_chars += len(part)
+                yield part
+        
+        chunks = self.document_processor.split_stream(
+            counted(itertools.chain(head, parts)),
+            chunk_size=config.CHUNK_SIZE,
+            chunk_overlap=config.CHUNK_OVERLAP
+        )
+        
+        # Заменяем старый документ пользователя новым: коллекция не пересоздается,
+        # совпадающие чанки остаются в индексе
+        n_chunks = self.vector_store.replace_documents(
+            user_id,
+            chunks,
+            metadatas=({"source": file_name, "chunk_index": i} for i in itertools.count()),
+            doc_hash=doc_hash
+        )
+        self._prune_document_cache()
+        return n_chars, n_chunks
+    
+    def _prune_document_cache(self) -> None:
+        """
+        Ограничивает дисковый кэш документов по возрасту и общему размеру,
+        а кэш эмбеддингов в ChromaDB - по возрасту.
+        """
+        max_age_seconds = config.DOCUMENT_CACHE_MAX_AGE_DAYS * 24 * 3600
+        prune_cache(
+            config.DOCUMENT_CACHE_DIR,
+            max_age_seconds=max_age_seconds,
+            max_bytes=config.DOCUMENT_CACHE_MAX_MB * 1024 * 1024
+        )
+        self.vector_store.prune_embedding_cache(max_age_seconds)
+    
     async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Обработчик загрузки документов.
@@ -171,8 +336,8 @@ class RAGBot:
         file_name = document.file_name
         file_ext = os.path.splitext(file_name)[1].lower()
         
-        # Проверяем формат файла
-        if file_ext not in ['.pdf', '.txt', '.docx']:
+        # Проверяем формат файла по уже вычисленному расширению
+        if file_ext not in self.document_processor.supported_formats:
             await update.message.reply_text(
                 "❌ Неподдерживаемый формат файла. "
                 "Поддерживаются: PDF, TXT, DOCX"
@@ -186,63 +351,36 @@ class RAGBot:
         )
         
         try:
-            # Создаем директорию для временных файлов, если её нет
-            temp_dir = "./temp_files"
-            os.makedirs(temp_dir, exist_ok=True)
-            
-            # Скачиваем файл
+            # Скачиваем файл в память (без промежуточного файла на диске)
             file = await context.bot.get_file(document.file_id)
-            temp_file_path = os.path.join(temp_dir, f"temp_{user_id}_{file_name}")
-            await file.download_to_drive(temp_file_path)
+            file_buffer = BytesIO()
+            await file.download_to_memory(file_buffer)
+            file_buffer.seek(0)
             
-            # Сохраняем путь к временному файлу
-            if user_id in self.temp_files:
-                old_file = self.temp_files[user_id]
-                if os.path.exists(old_file):
-                    os.remove(old_file)
-            self.temp_files[user_id] = temp_file_path
-            
-            # Извлекаем текст из документа
-            logger.info(f"Извлечение текста из {file_name} для пользователя {user_id}")
-            text = self.document_processor.extract_text(temp_file_path)
+            async with self._ingest_semaphore:
+                logger.info(f"Потоковая обработка {file_name} для пользователя {user_id}")
+                n_chars, n_chunks = await self._run_blocking(
+                    self._ingest_document, user_id, file_buffer, file_ext, file_name
+                )
             
-            if not text or len(text.strip()) < 50:
+            if n_chars < MIN_TEXT_LENGTH:
                 await processing_msg.edit_text(
                     "❌ Не удалось извлечь текст из документа или документ слишком короткий."
                 )
                 return
             
-            # Разбиваем текст на чанки
-            logger.info(f"Разбивка текста на чанки для пользователя {user_id}")
-            chunks = self.document_processor.split_text_into_chunks(
-                text,
-                chunk_size=config.CHUNK_SIZE,
-                chunk_overlap=config.CHUNK_OVERLAP
-            )
-            
-            if not chunks:
+            if not n_chunks:
                 await processing_msg.edit_text("❌ Не удалось разбить документ на части.")
                 return
             
-            # Очищаем старую коллекцию пользователя перед добавлением нового документа
-            self.vector_store.clear_user_collection(user_id)
-            
-            # Добавляем чанки в векторную БД
-            logger.info(f"Добавление {len(chunks)} чанков в БД для пользователя {user_id}")
-            self.vector_store.add_documents(
-                user_id,
-                chunks,
-                metadatas=[{"source": file_name, "chunk_index": i} for i in range(len(chunks))]
-            )
-            
             # Очищаем память диалога при загрузке нового документа
             self.clear_memory(user_id)
             
             await processing_msg.edit_text(
                 f"✅ Документ '{file_name}' успешно обработан!\n\n"
                 f"📊 Статистика:\n"
-                f"• Извлечено символов: {len(text)}\n"
-                f"• Создано чанков: {len(chunks)}\n\n"
+                f"• Извлечено символов: {n_chars}\n"
+                f"• Создано чанков: {n_chunks}\n\n"
                 f"Теперь вы можете задавать вопросы по содержимому документа."
             )
             logger.info(f"Документ {file_name} успешно обработан для пользователя {user_id}")
@@ -269,7 +407,8 @@ class RAGBot:
             return
         
         # Проверяем, есть ли документы у пользователя
-        doc_count = self.vector_store.get_collection_count(user_id)
+        # (запросы к ChromaDB блокирующие, поэтому выполняем их в отдельном потоке)
+        doc_count = await asyncio.to_thread(self.vector_store.get_collection_count, user_id)
         if doc_count == 0:
             await update.message.reply_text(
                 "📄 Сначала загрузите документ, чтобы я мог ответить на ваши вопросы.\n"
@@ -283,7 +422,9 @@ class RAGBot:
         try:
             # Выполняем поиск релевантных чанков
             logger.info(f"Поиск релевантных чанков для вопроса пользователя {user_id}")
-            search_results = self.vector_store.search(user_id, question, n_results=3)
+            search_results = await asyncio.to_thread(
+                self.vector_store.search, user_id, question, n_results=3
+            )
             
             if not search_results:
                 await thinking_msg.edit_text(
@@ -298,54 +439,55 @@ class RAGBot:
             # Получаем память диалога
             chat_history = self.get_memory(user_id)
             
-            # Формируем системный промпт с контекстом
-            system_prompt = (
-                "Ты - полезный AI-ассистент, который отвечает на вопросы пользователей "
-                "на основе предоставленного контекста из документов.\n\n"
-                "Инструкции:\n"
-                "1. Отвечай ТОЛЬКО на основе предоставленного контекста\n"
-                "2. Если в контексте нет информации для ответа, честно скажи об этом\n"
-                "3. Отвечай на русском языке\n"
-                "4. Будь точным и информативным\n"
-                "5. Используй контекст предыдущих сообщений для лучшего понимания\n\n"
-                f"Контекст из документов:\n{context}"
-            )
-            
-            # Формируем список сообщений для LLM (используем объекты LangChain)
-            messages = [SystemMessage(content=system_prompt)]
+            # Формируем список сообщений для LLM (используем объекты LangChain):
+            # неизменные инструкции и контекст из документов - отдельными системными сообщениями
+            messages = [
+                INSTRUCTION_MSG,
+                SystemMessage(content=f"Контекст из документов:\n{context}")
+            ]
             
-            # Добавляем историю диалога (последние 6 пар вопрос-ответ)
-            for msg in chat_history[-6:]:
-                if isinstance(msg, HumanMessage):
-                    messages.append(msg)
-                elif isinstance(msg, AIMessage):
-                    messages.append(msg)
-                elif isinstance(msg, dict):
-                    # Поддержка старого формата (словари)
-                    if msg.get("role") == "user":
-                        messages.append(HumanMessage(content=msg.get("content", "")))
-                    elif msg.get("role") == "assistant":
-                        messages.append(AIMessage(content=msg.get("content", "")))
+            # Добавляем историю диалога (последние 6 сообщений). В памяти хранятся
+            # готовые объекты HumanMessage/AIMessage, поэтому они добавляются как есть
+            messages.extend(list(chat_history)[-6:])
             
             # Добавляем текущий вопрос
             messages.append(HumanMessage(content=question))
             
-            # Генерируем ответ
+            # Генерируем ответ потоково: сообщение обновляется по мере генерации,
+            # не чаще раза в STREAM_EDIT_INTERVAL секунд (лимит Telegram на редактирование)
             logger.info(f"Генерация ответа для пользователя {user_id}")
-            response = self.llm.invoke(messages)
-            answer = response.content if hasattr(response, 'content') else str(response)
+            parts = []
+            shown_text = ""
+            last_edit = time.monotonic()
+            async for chunk in self.llm.astream(messages):
+                parts.append(chunk.content)
+                now = time.monotonic()
+                if now - last_edit >= config.STREAM_EDIT_INTERVAL:
+                    partial = "".join(parts)
+                    if partial.strip() and partial != shown_text:
+                        await self._safe_edit_text(thinking_msg, partial)
+                        shown_text = partial
+                    last_edit = time.monotonic()
+            answer = "".join(parts)
             
-            # Сохраняем вопрос и ответ в память (используем объекты LangChain)
+            # Пустой ответ Telegram не покажет, а в памяти диалога он бесполезен:
+            # заменяем "Думаю..." сообщением об ошибке и историю не пополняем
+            if not answer.strip():
+                logger.warning(f"Модель вернула пустой ответ пользователю {user_id}")
+                await self._safe_edit_text(
+                    thinking_msg,
+                    "❌ Не удалось получить ответ от модели. Попробуйте задать вопрос еще раз."
+                )
+                return
+            
+            # Сохраняем вопрос и ответ в память (используем объекты LangChain).
+            # Очередь ограничена HISTORY_LEN, старые сообщения удаляются сами
             chat_history.append(HumanMessage(content=question))
             chat_history.append(AIMessage(content=answer))
             
-            # Ограничиваем размер истории (храним последние 10 сообщений)
-            if len(chat_history) > 10:
-                chat_history = chat_history[-10:]
-                self.memories[user_id] = chat_history
-            
-            # Отправляем ответ пользователю
-            await thinking_msg.edit_text(answer)
+            # Отправляем окончательный ответ пользователю
+            if answer != shown_text:
+                await self._safe_edit_text(thinking_msg, answer)
             logger.info(f"Ответ отправлен пользователю {user_id}")
             
         except Exception as e:
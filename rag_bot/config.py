@@ -4,6 +4,8 @@
 """
 
 import os
+import socket
+import uuid
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env файла
@@ -29,12 +31,93 @@ if not GROQ_API_KEY or GROQ_API_KEY == "your_groq_api_key_here":
 CHUNK_SIZE = 1000  # Размер чанка в символах
 CHUNK_OVERLAP = 200  # Перекрытие между чанками в символах
 
+# Параллельная обработка загружаемых документов
+INGEST_WORKERS = 4  # Потоки для парсинга, эмбеддингов и записи в ChromaDB
+MAX_CONCURRENT_INGESTIONS = 2  # Сколько документов обрабатывается одновременно
+INGEST_BATCH_SIZE = 256  # Сколько чанков документа эмбеддится и записывается в ChromaDB за раз
+
+# Память диалога
+HISTORY_LEN = 10  # Сколько последних сообщений хранится для каждого пользователя
+MAX_ACTIVE_USERS = 10000  # Для скольких пользователей хранится память (давно неактивные вытесняются)
+
+# Подключаться к Telegram и Groq только по IPv4 (решает проблему таймаутов SSL при IPv6)
+FORCE_IPV4 = os.getenv("FORCE_IPV4", "true").strip().lower() in ("1", "true", "yes")
+
+# Пулы HTTP соединений (Groq и Telegram Bot API)
+HTTP_KEEPALIVE_CONNECTIONS = 32  # Сколько простаивающих соединений держать открытыми
+HTTP_MAX_CONNECTIONS = 64  # Максимум одновременных соединений
+
+# Минимальный интервал (в секундах) между редактированиями сообщения при потоковом ответе
+STREAM_EDIT_INTERVAL = 0.75
+
 # Путь к базе данных ChromaDB
 CHROMA_DB_PATH = "./chroma_db"
 
+# Дисковый кэш извлеченного текста и эмбеддингов документов (ключ - SHA-256 файла).
+# Хранится по пользователям и удаляется командой /clear; давно не использованные файлы
+# удаляются по возрасту, а при превышении общего размера - начиная с самых старых.
+# По тому же возрасту очищается кэш эмбеддингов чанков в ChromaDB
+DOCUMENT_CACHE_DIR = os.path.join(CHROMA_DB_PATH, "cache")
+DOCUMENT_CACHE_MAX_AGE_DAYS = 7
+DOCUMENT_CACHE_MAX_MB = 512
+
 # Модель для эмбеддингов (легкая и быстрая модель от Sentence Transformers)
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 
+# Путь к квантованной (int8) ONNX версии модели эмбеддингов.
+# Если задан, эмбеддинги считаются через ONNX Runtime вместо PyTorch.
+# Создается один раз через rag_bot.vector_store.quantize_embedding_model.
+EMBEDDING_ONNX_PATH = os.getenv("EMBEDDING_ONNX_PATH", "").strip() or None
+
+# Размер батча при создании эмбеддингов (чанки кодируются пачками за один вызов модели)
+EMBED_BATCH_SIZE = 64
+
 # Модель Groq для генерации ответов
 GROQ_MODEL = "llama-3.1-8b-instant"  # Быстрая модель, можно изменить на llama-3.1-70b-versatile для лучшего качества
 
+
+# Режим получения обновлений от Telegram.
+# В продакшене бот работает через webhook за reverse proxy, long-polling оставлен для разработки.
+USE_WEBHOOK = os.getenv("USE_WEBHOOK", "false").strip().lower() in ("1", "true", "yes")
+
+# Публичный HTTPS адрес, на который reverse proxy принимает запросы Telegram (например, https://bot.example.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+
+# Адрес и порт, на которых бот слушает входящие webhook запросы
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET", "").strip() or None
+
+# Роль процесса при горизонтальном масштабировании:
+#   standalone - бот сам получает обновления (webhook или polling)
+#   ingress - принимает webhook от Telegram и складывает обновления в Redis Stream
+#   worker - читает обновления из Redis Stream и обрабатывает их (по одному воркеру на шард)
+BOT_ROLE = os.getenv("BOT_ROLE", "standalone").strip().lower()
+
+# Redis Stream для очереди обновлений (роли ingress и worker)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0").strip()
+REDIS_STREAM = "updates"  # Префикс потоков: по одному потоку updates:<шард> на шард
+
+# Шардирование по user_id: обновления пользователя всегда попадают в поток shard = user_id % REDIS_SHARDS,
+# который читает один воркер. Состояние пользователя (ChromaDB, история диалога, кэши)
+# живет в одном процессе, поэтому воркеры не делят ни базу, ни память
+REDIS_SHARDS = int(os.getenv("REDIS_SHARDS", "1"))  # Должно совпадать у ingress и всех воркеров
+WORKER_SHARD = int(os.getenv("WORKER_SHARD", "0"))  # Номер шарда воркера: 0..REDIS_SHARDS-1
+REDIS_GROUP = "rag"
+REDIS_STREAM_MAXLEN = 100_000  # Примерный предел длины потока
+UPDATE_BATCH_SIZE = 32  # Сколько обновлений воркер забирает за один запрос
+MAX_CONCURRENT_UPDATES = 64  # Сколько обновлений воркер обрабатывает одновременно
+# Имя потребителя в группе: должно быть уникальным у каждого процесса
+WORKER_ID = os.getenv("WORKER_ID", "").strip() or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+# Неподтвержденные записи, которые дольше CLAIM_MIN_IDLE_MS не обрабатываются (воркер упал или
+# перезапущен под другим именем), забираются через XAUTOCLAIM раз в CLAIM_INTERVAL секунд.
+# Время должно быть больше самой долгой обработки (загрузка документа), иначе запись обработается дважды
+CLAIM_MIN_IDLE_MS = 10 * 60 * 1000
+CLAIM_INTERVAL = 30
+
+# У каждого воркера своя база ChromaDB (PersistentClient нельзя открывать из нескольких процессов)
+if BOT_ROLE == "worker":
+    CHROMA_DB_PATH = os.path.join(CHROMA_DB_PATH, f"shard_{WORKER_SHARD}")
+    DOCUMENT_CACHE_DIR = os.path.join(CHROMA_DB_PATH, "cache")
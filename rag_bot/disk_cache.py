@@ -0,0 +1,132 @@
+"""
+Модуль дискового кэша документов пользователей.
+Кэш хранится по пользователям (cache_dir/<user_id>/), поэтому удаляется целиком по /clear,
+и ограничивается по возрасту и общему размеру.
+"""
+
+import os
+import time
+import shutil
+import logging
+import threading
+from typing import IO
+
+logger = logging.getLogger(__name__)
+
+# Создание директории пользователя вместе с открытием файла в ней и удаление пустых
+# директорий в prune_cache идут под одной блокировкой: иначе очистка кэша после одной
+# загрузки может удалить директорию, в которой параллельная загрузка еще не создала файл
+_dir_lock = threading.Lock()
+
+
+def user_cache_dir(cache_dir: str, user_id: int) -> str:
+    """
+    Возвращает директорию кэша пользователя.
+    
+    Args:
+        cache_dir: Корневая директория кэша
+        user_id: ID пользователя Telegram
+    
+    Returns:
+        Путь к директории кэша пользователя
+    """
+    return os.path.join(cache_dir, str(user_id))
+
+
+def open_cache_file(path: str, mode: str, **kwargs) -> IO:
+    """
+    Открывает файл кэша, создавая его директорию при необходимости.
+    
+    Args:
+        path: Путь к файлу кэша
+        mode: Режим открытия файла (как в open)
+        **kwargs: Остальные аргументы open (например, encoding)
+    
+    Returns:
+        Открытый файл
+    """
+    with _dir_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, mode, **kwargs)
+
+
+def clear_user_cache(cache_dir: str, user_id: int) -> None:
+    """
+    Удаляет весь кэш пользователя (извлеченный текст и эмбеддинги его документов).
+    
+    Args:
+        cache_dir: Корневая директория кэша
+        user_id: ID пользователя Telegram
+    """
+    shutil.rmtree(user_cache_dir(cache_dir, user_id), ignore_errors=True)
+
+
+def prune_cache(cache_dir: str, max_age_seconds: float, max_bytes: int) -> None:
+    """
+    Удаляет файлы кэша старше max_age_seconds, а если общий размер больше max_bytes -
+    дополнительно самые давно использованные файлы (время изменения обновляется при попадании в кэш).
+    
+    Args:
+        cache_dir: Корневая директория кэша
+        max_age_seconds: Максимальный возраст файла в секундах
+        max_bytes: Максимальный общий размер кэша в байтах
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    
+    now = time.time()
+    files = []
+    removed = 0
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > max_age_seconds:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+            elif not name.endswith(".tmp"):
+                # Временные файлы еще дописываются, по размеру их не удаляем
+                files.append((stat.st_mtime, stat.st_size, path))
+    
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    
+    # Удаляем опустевшие директории пользователей
+    with _dir_lock:
+        for entry in os.scandir(cache_dir):
+            if entry.is_dir():
+                try:
+                    # Удаляется, только если директория пуста
+                    os.rmdir(entry.path)
+                except OSError:
+                    pass
+    
+    if removed:
+        logger.info(f"Из кэша документов удалено файлов: {removed}")
+
+
+def touch(path: str) -> None:
+    """
+    Отмечает использование файла кэша (обновляет время изменения).
+    
+    Args:
+        path: Путь к файлу кэша
+    """
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
@@ -4,10 +4,31 @@
 """
 
 import os
-from typing import List
-from pathlib import Path
+import hashlib
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from .disk_cache import open_cache_file, touch, user_cache_dir
+
+# Источник документа: путь к файлу или файлоподобный объект (например, BytesIO)
+DocumentSource = Union[str, os.PathLike, BinaryIO]
 
 # Импорты для обработки разных форматов
+# PyMuPDF: извлечение текста из PDF на C (MuPDF).
+# Новые версии импортируются как pymupdf, старые - как fitz
+try:
+    import pymupdf as fitz
+except ImportError:
+    try:
+        import fitz
+    except ImportError:
+        fitz = None
+
 try:
     from pypdf import PdfReader
 except ImportError:
@@ -18,6 +39,55 @@ try:
 except ImportError:
     Document = None
 
+try:
+    from charset_normalizer import from_bytes
+except ImportError:
+    from_bytes = None
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые расширения файлов
+_SUPPORTED = frozenset({'.pdf', '.txt', '.docx'})
+
+# Максимум процессов для extract_text_batch по умолчанию:
+# каждый процесс - отдельный интерпретатор со своими PyMuPDF/pypdf/python-docx
+MAX_BATCH_WORKERS = 4
+
+
+def _clean_text(text: str) -> str:
+    """
+    Заменяет одиночные суррогаты (их может вернуть разбор PDF/DOCX) на "?":
+    такой текст нельзя записать в UTF-8 (кэш на диске, хэш чанка, ChromaDB).
+    
+    Args:
+        text: Извлеченный текст
+        
+    Returns:
+        Текст, который без ошибок кодируется в UTF-8
+    """
+    return text.encode("utf-8", "replace").decode("utf-8")
+
+
+def file_hash(file_path: DocumentSource) -> str:
+    """
+    Вычисляет SHA-256 содержимого файла (ключ дискового кэша документа).
+    Позиция файлоподобного объекта после вызова не меняется.
+    
+    Args:
+        file_path: Путь к файлу или файлоподобный объект
+        
+    Returns:
+        Хэш в шестнадцатеричном виде
+    """
+    if hasattr(file_path, 'read'):
+        position = file_path.tell()
+        data = file_path.read()
+        file_path.seek(position)
+    else:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    return hashlib.sha256(data).hexdigest()
+
 
 class DocumentProcessor:
     """
@@ -25,9 +95,25 @@ class DocumentProcessor:
     Извлекает текст из PDF, TXT и DOCX файлов.
     """
     
-    def __init__(self):
-        """Инициализация процессора документов."""
-        self.supported_formats = ['.pdf', '.txt', '.docx']
+    def __init__(self, cache_dir: Optional[str] = None):
+        """
+        Инициализация процессора документов.
+        
+        Args:
+            cache_dir: Директория для кэша извлеченного текста по хэшу файла, по поддиректории
+                на пользователя (если None - без кэша)
+        """
+        self.supported_formats = _SUPPORTED
+        self.cache_dir = cache_dir
+        
+        # Метод извлечения текста по расширению файла
+        self._readers = {
+            '.pdf': self.iter_pages_from_pdf,
+            '.txt': self._iter_txt,
+            '.docx': self.iter_paragraphs_from_docx,
+        }
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
     
     def is_supported(self, file_path: str) -> bool:
         """
@@ -39,110 +125,314 @@ class DocumentProcessor:
         Returns:
             True, если формат поддерживается, иначе False
         """
-        file_ext = Path(file_path).suffix.lower()
-        return file_ext in self.supported_formats
+        return os.path.splitext(file_path)[1].lower() in _SUPPORTED
     
-    def extract_text_from_pdf(self, file_path: str) -> str:
+    def extract_text_from_pdf(self, file_path: DocumentSource) -> str:
         """
         Извлекает текст из PDF файла.
+        Использует PyMuPDF, если он установлен, иначе pypdf.
         
         Args:
-            file_path: Путь к PDF файлу
+            file_path: Путь к PDF файлу или файлоподобный объект
             
         Returns:
             Извлеченный текст
         """
-        if PdfReader is None:
-            raise ImportError("pypdf не установлен. Установите: pip install pypdf")
+        return "".join(self.iter_pages_from_pdf(file_path)).strip()
+    
+    def iter_pages_from_pdf(self, file_path: DocumentSource) -> Iterator[str]:
+        """
+        Отдает текст PDF по страницам: в памяти одновременно только одна страница.
+        Каждая страница заканчивается переводом строки.
+        
+        Args:
+            file_path: Путь к PDF файлу или файлоподобный объект
+            
+        Yields:
+            Текст очередной страницы
+        """
+        if fitz is None and PdfReader is None:
+            raise ImportError("Не установлен ни PyMuPDF, ни pypdf. Установите: pip install pymupdf")
+        
+        if fitz is not None:
+            try:
+                if hasattr(file_path, 'read'):
+                    doc = fitz.open(stream=file_path.read(), filetype="pdf")
+                else:
+                    doc = fitz.open(file_path)
+                # Режим "text" - простой текст без анализа разметки, для чанкинга он не нужен
+                with doc:
+                    for page in doc:
+                        text = _clean_text(page.get_text("text"))
+                        # Пустые страницы (сканы, разделители) не передаем дальше
+                        if text.strip():
+                            yield text + "\n"
+            except Exception as e:
+                raise Exception(f"Ошибка при чтении PDF: {str(e)}")
+            return
         
-        text = ""
         try:
             reader = PdfReader(file_path)
-            # Проходим по всем страницам и извлекаем текст
             for page in reader.pages:
-                text += page.extract_text() + "\n"
+                # pypdf может вернуть None для страницы без текста
+                text = page.extract_text()
+                if text and text.strip():
+                    text = _clean_text(text)
+                    yield text + "\n"
         except Exception as e:
             raise Exception(f"Ошибка при чтении PDF: {str(e)}")
-        
-        return text.strip()
     
-    def extract_text_from_txt(self, file_path: str) -> str:
+    def extract_text_from_txt(self, file_path: DocumentSource) -> str:
         """
         Извлекает текст из TXT файла.
+        Файл читается один раз; если он не в UTF-8, кодировка определяется
+        charset-normalizer за один проход, и байты декодируются один раз.
         
         Args:
-            file_path: Путь к TXT файлу
+            file_path: Путь к TXT файлу или файлоподобный объект
             
         Returns:
             Извлеченный текст
         """
         try:
-            # Пробуем разные кодировки
-            encodings = ['utf-8', 'cp1251', 'latin-1']
-            for encoding in encodings:
-                try:
-                    with open(file_path, 'r', encoding=encoding) as f:
-                        return f.read().strip()
-                except UnicodeDecodeError:
-                    continue
-            raise Exception("Не удалось определить кодировку файла")
+            if hasattr(file_path, 'read'):
+                raw = file_path.read()
+            else:
+                with open(file_path, 'rb') as f:
+                    raw = f.read()
+            
+            # Быстрый путь: большинство файлов в UTF-8
+            try:
+                return raw.decode('utf-8').strip()
+            except UnicodeDecodeError:
+                pass
+            
+            if from_bytes is not None:
+                best = from_bytes(raw).best()
+                encoding = best.encoding if best is not None else 'cp1251'
+            else:
+                # Без charset-normalizer считаем файл кириллицей в Windows-кодировке
+                encoding = 'cp1251'
+            return raw.decode(encoding, errors='replace').strip()
         except Exception as e:
             raise Exception(f"Ошибка при чтении TXT: {str(e)}")
     
-    def extract_text_from_docx(self, file_path: str) -> str:
+    def extract_text_from_docx(self, file_path: DocumentSource) -> str:
         """
         Извлекает текст из DOCX файла.
         
         Args:
-            file_path: Путь к DOCX файлу
+            file_path: Путь к DOCX файлу или файлоподобный объект
             
         Returns:
             Извлеченный текст
         """
+        return "".join(self.iter_paragraphs_from_docx(file_path)).strip()
+    
+    def iter_paragraphs_from_docx(self, file_path: DocumentSource) -> Iterator[str]:
+        """
+        Отдает текст DOCX по параграфам, каждый параграф заканчивается переводом строки.
+        
+        Args:
+            file_path: Путь к DOCX файлу или файлоподобный объект
+            
+        Yields:
+            Текст очередного параграфа
+        """
         if Document is None:
             raise ImportError("python-docx не установлен. Установите: pip install python-docx")
         
         try:
             doc = Document(file_path)
-            text = ""
-            # Извлекаем текст из всех параграфов
             for paragraph in doc.paragraphs:
-                text += paragraph.text + "\n"
-            return text.strip()
+                yield _clean_text(paragraph.text) + "\n"
         except Exception as e:
             raise Exception(f"Ошибка при чтении DOCX: {str(e)}")
     
-    def extract_text(self, file_path: str) -> str:
+    def extract_text(
+        self,
+        file_path: DocumentSource,
+        file_ext: Optional[str] = None,
+        doc_hash: Optional[str] = None,
+        user_id: Optional[int] = None
+    ) -> str:
         """
         Извлекает текст из файла любого поддерживаемого формата.
+        Если задан cache_dir и передан user_id, текст кэшируется на диске пользователя
+        по SHA-256 содержимого файла, и повторная загрузка того же файла не разбирается заново.
         
         Args:
-            file_path: Путь к файлу
+            file_path: Путь к файлу или файлоподобный объект (например, BytesIO)
+            file_ext: Расширение файла в нижнем регистре (обязательно для файлоподобного объекта)
+            doc_hash: Заранее вычисленный хэш файла (file_hash), чтобы не считать его повторно
+            user_id: ID пользователя Telegram, в чей кэш сохраняется текст (если None - без кэша)
             
         Returns:
             Извлеченный текст
         """
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"Файл не найден: {file_path}")
+        return "".join(self.iter_text(file_path, file_ext, doc_hash, user_id)).strip()
+    
+    def iter_text(
+        self,
+        file_path: DocumentSource,
+        file_ext: Optional[str] = None,
+        doc_hash: Optional[str] = None,
+        user_id: Optional[int] = None
+    ) -> Iterator[str]:
+        """
+        Извлекает текст файла по частям (страницы PDF, параграфы DOCX), не собирая весь текст в памяти.
+        Склейка частей дает полный текст документа. Кэш на диске работает так же, как в extract_text.
         
-        if not self.is_supported(file_path):
-            raise ValueError(f"Неподдерживаемый формат файла: {Path(file_path).suffix}")
+        Args:
+            file_path: Путь к файлу или файлоподобный объект (например, BytesIO)
+            file_ext: Расширение файла в нижнем регистре (обязательно для файлоподобного объекта)
+            doc_hash: Заранее вычисленный хэш файла (file_hash), чтобы не считать его повторно
+            user_id: ID пользователя Telegram, в чей кэш сохраняется текст (если None - без кэша)
+            
+        Returns:
+            Итератор частей текста
+        """
+        if hasattr(file_path, 'read'):
+            if not file_ext:
+                raise ValueError("Для файлоподобного объекта необходимо указать расширение файла")
+        else:
+            if not os.path.exists(file_path):
+                raise FileNotFoundError(f"Файл не найден: {file_path}")
+            if file_ext is None:
+                file_ext = os.path.splitext(file_path)[1].lower()
         
-        file_ext = Path(file_path).suffix.lower()
+        if file_ext not in _SUPPORTED:
+            raise ValueError(f"Неподдерживаемый формат файла: {file_ext}")
         
-        # Выбираем метод извлечения в зависимости от формата
-        if file_ext == '.pdf':
-            return self.extract_text_from_pdf(file_path)
-        elif file_ext == '.txt':
-            return self.extract_text_from_txt(file_path)
-        elif file_ext == '.docx':
-            return self.extract_text_from_docx(file_path)
-        else:
+        if not self.cache_dir or user_id is None:
+            return self._iter_pages(file_path, file_ext)
+        
+        if doc_hash is None:
+            doc_hash = file_hash(file_path)
+        cache_path = os.path.join(user_cache_dir(self.cache_dir, user_id), f"{doc_hash}.txt")
+        return self._iter_text_cached(file_path, file_ext, cache_path)
+    
+    def _iter_text_cached(self, file_path: DocumentSource, file_ext: str, cache_path: str) -> Iterator[str]:
+        """
+        Отдает текст из кэша, а при промахе извлекает его и по мере извлечения пишет в кэш.
+        
+        Args:
+            file_path: Путь к файлу или файлоподобный объект
+            file_ext: Расширение файла в нижнем регистре
+            cache_path: Путь к файлу кэша
+            
+        Yields:
+            Части текста
+        """
+        if os.path.exists(cache_path):
+            logger.info(f"Текст документа {os.path.basename(cache_path)[:12]} взят из кэша")
+            touch(cache_path)
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                while block := f.read(1 << 20):
+                    yield block
+            return
+        
+        # Пишем во временный файл и атомарно переименовываем после полного извлечения,
+        # чтобы параллельная обработка не прочитала недописанный кэш
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open_cache_file(tmp_path, 'w', encoding='utf-8') as f:
+                for part in self._iter_pages(file_path, file_ext):
+                    f.write(part)
+                    yield part
+            os.replace(tmp_path, cache_path)
+        finally:
+            # Извлечение прервано (ошибка или итератор не дочитан) - кэш не сохраняем
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def extract_text_batch(self, file_paths: Sequence[str], max_workers: Optional[int] = None) -> List[str]:
+        """
+        Извлекает текст из нескольких файлов параллельно в пуле процессов
+        (разбор PDF/DOCX упирается в CPU, процессы не делят GIL).
+        
+        Args:
+            file_paths: Пути к файлам
+            max_workers: Количество процессов (по умолчанию - число ядер, но не больше MAX_BATCH_WORKERS)
+            
+        Returns:
+            Список извлеченных текстов в порядке файлов
+        """
+        if not file_paths:
+            return []
+        if len(file_paths) == 1:
+            return [self.extract_text(file_paths[0])]
+        
+        if max_workers is None:
+            max_workers = min(os.cpu_count() or 1, MAX_BATCH_WORKERS)
+        max_workers = min(max_workers, len(file_paths))
+        # spawn: процессы не наследуют через fork потоки бота (пулы, writer ChromaDB)
+        # и захваченные ими блокировки, из-за которых fork-дочерний процесс может зависнуть
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            return list(executor.map(_extract_text_worker, file_paths))
+    
+    def _iter_pages(self, file_path: DocumentSource, file_ext: str) -> Iterator[str]:
+        """
+        Извлекает текст по частям, выбирая метод по расширению файла.
+        
+        Args:
+            file_path: Путь к файлу или файлоподобный объект
+            file_ext: Расширение файла в нижнем регистре
+            
+        Returns:
+            Итератор частей текста
+        """
+        reader = self._readers.get(file_ext)
+        if reader is None:
             raise ValueError(f"Неподдерживаемый формат: {file_ext}")
+        return reader(file_path)
+    
+    def _iter_txt(self, file_path: DocumentSource) -> Iterator[str]:
+        """
+        Отдает текст TXT файла одной частью: кодировку нужно определять по всему файлу.
+        
+        Args:
+            file_path: Путь к TXT файлу или файлоподобный объект
+            
+        Returns:
+            Итератор из одной части текста
+        """
+        return iter([self.extract_text_from_txt(file_path)])
+    
+    @staticmethod
+    def _find_boundaries(text: str) -> np.ndarray:
+        """
+        Находит позиции, по которым удобно разрезать текст: после конца предложения
+        (., !, ? и пробельный символ) и после перевода строки.
+        Поиск выполняется векторно в NumPy по массиву кодов символов.
+        
+        Args:
+            text: Исходный текст
+            
+        Returns:
+            Отсортированный массив позиций (индексы символов, на которых может заканчиваться чанк)
+        """
+        # UTF-32 дает по одному элементу на символ, поэтому индексы совпадают с индексами в str
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        
+        newline = codes == ord("\n")
+        whitespace = newline | (codes == ord(" ")) | (codes == ord("\t")) | (codes == ord("\r"))
+        punct = (codes == ord(".")) | (codes == ord("!")) | (codes == ord("?"))
+        
+        # Конец предложения: знак препинания, за которым следует пробельный символ
+        sentence_end = np.flatnonzero(punct[:-1] & whitespace[1:]) + 2
+        line_end = np.flatnonzero(newline) + 1
+        
+        return np.union1d(sentence_end, line_end)
     
     def split_text_into_chunks(self, text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> List[str]:
         """
-        Разбивает текст на чанки с перекрытием.
+        Разбивает текст на чанки с перекрытием (скользящее окно с шагом chunk_size - chunk_overlap).
+        Чанк по возможности заканчивается на границе предложения или строки.
+        Границы всех чанков вычисляются сразу массивами NumPy, без цикла по чанкам.
         
         Args:
             text: Текст для разбивки
@@ -155,32 +445,104 @@ class DocumentProcessor:
         if not text:
             return []
         
-        chunks = []
-        start = 0
+        starts, ends = self._chunk_bounds(text, chunk_size, chunk_overlap)
         
-        # Разбиваем текст на чанки
-        while start < len(text):
-            # Определяем конец текущего чанка
-            end = start + chunk_size
+        # Извлекаем непустые чанки
+        chunks = [text[start:end].strip() for start, end in zip(starts.tolist(), ends.tolist())]
+        return [chunk for chunk in chunks if chunk]
+    
+    def split_stream(self, parts: Iterable[str], chunk_size: int = 1000, chunk_overlap: int = 200) -> Iterator[str]:
+        """
+        Разбивает на чанки текст, который поступает по частям (например, iter_text).
+        В буфере хранится только текст, еще не попавший в готовые чанки, поэтому память
+        не зависит от размера документа. Результат совпадает с split_text_into_chunks
+        для склеенного текста.
+        
+        Args:
+            parts: Части текста
+            chunk_size: Размер чанка в символах
+            chunk_overlap: Перекрытие между чанками в символах
             
-            # Если это не последний чанк, пытаемся разбить по предложению
-            if end < len(text):
-                # Ищем ближайшую точку, восклицательный или вопросительный знак
-                for punct in ['. ', '! ', '? ', '\n\n', '\n']:
-                    last_punct = text.rfind(punct, start, end)
-                    if last_punct != -1:
-                        end = last_punct + len(punct)
-                        break
+        Yields:
+            Непустые текстовые чанки
+        """
+        stride = chunk_size - chunk_overlap
+        buffer = ""
+        for part in parts:
+            buffer += part
+            if len(buffer) <= chunk_size:
+                continue
             
-            # Извлекаем чанк
-            chunk = text[start:end].strip()
-            if chunk:  # Добавляем только непустые чанки
-                chunks.append(chunk)
+            # Выдаем только окна, за концом которых в буфере уже есть текст:
+            # последние окна еще могут измениться с приходом следующей части
+            starts, ends = self._chunk_bounds(buffer, chunk_size, chunk_overlap, final=False)
+            if not len(starts):
+                continue
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                chunk = buffer[start:end].strip()
+                if chunk:
+                    yield chunk
+            buffer = buffer[int(starts[-1]) + stride:]
+        
+        yield from self.split_text_into_chunks(buffer, chunk_size, chunk_overlap)
+    
+    def _chunk_bounds(
+        self,
+        text: str,
+        chunk_size: int,
+        chunk_overlap: int,
+        final: bool = True
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Вычисляет границы чанков скользящего окна.
+        
+        Args:
+            text: Текст для разбивки
+            chunk_size: Размер чанка в символах
+            chunk_overlap: Перекрытие между чанками в символах
+            final: Текст закончился; если False, возвращаются только окна, которые целиком
+                помещаются в текст и не касаются его конца
             
-            # Перемещаемся на следующий чанк с учетом перекрытия
-            start = end - chunk_overlap
-            if start >= len(text):
-                break
+        Returns:
+            Массивы начал и концов чанков
+        """
+        stride = chunk_size - chunk_overlap
+        if stride <= 0:
+            raise ValueError("chunk_overlap должен быть меньше chunk_size")
+        
+        text_len = len(text)
+        
+        # Начала окон: n = ceil((N - K) / S) + 1, последнее окно доходит до конца текста
+        n_chunks = -(-max(text_len - chunk_size, 0) // stride) + 1
+        starts = np.arange(n_chunks, dtype=np.int64) * stride
+        ends = np.minimum(starts + chunk_size, text_len)
         
-        return chunks
+        # Сдвигаем концы окон на последнюю границу предложения/строки внутри окна.
+        # Граница должна быть дальше начала следующего окна, иначе между чанками появится разрыв
+        boundaries = self._find_boundaries(text)
+        if len(boundaries):
+            idx = np.searchsorted(boundaries, ends, side="right") - 1
+            candidates = boundaries[np.maximum(idx, 0)]
+            snap = (idx >= 0) & (candidates > starts + stride) & (ends < text_len)
+            ends = np.where(snap, candidates, ends)
+        
+        if not final:
+            complete = starts + chunk_size < text_len
+            starts, ends = starts[complete], ends[complete]
+        
+        return starts, ends
 
+
+def _extract_text_worker(file_path: str) -> str:
+    """
+    Извлекает текст файла в процессе пула extract_text_batch.
+    Функция уровня модуля: при spawn дочерний процесс импортирует только этот модуль,
+    а не весь бот, как при передаче связанного метода DocumentProcessor.
+    
+    Args:
+        file_path: Путь к файлу
+        
+    Returns:
+        Извлеченный текст
+    """
+    return DocumentProcessor().extract_text(file_path)
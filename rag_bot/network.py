@@ -0,0 +1,31 @@
+"""
+Модуль с настройками HTTP соединений для Telegram Bot API и Groq.
+"""
+
+import httpx
+
+from . import config
+
+
+def create_http_transport(max_connections: int, max_keepalive_connections: int) -> httpx.AsyncHTTPTransport:
+    """
+    Создает асинхронный HTTP/2 транспорт с пулом соединений.
+    При FORCE_IPV4 исходящий сокет привязывается к 0.0.0.0, поэтому соединения
+    устанавливаются только по IPv4 (решает проблему таймаутов SSL при подключении по IPv6).
+    
+    Args:
+        max_connections: Максимум одновременных соединений
+        max_keepalive_connections: Сколько простаивающих соединений держать открытыми
+        
+    Returns:
+        Транспорт для httpx.AsyncClient
+    """
+    return httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=30
+        ),
+        local_address="0.0.0.0" if config.FORCE_IPV4 else None
+    )
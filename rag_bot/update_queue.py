@@ -0,0 +1,271 @@
+"""
+Модуль очереди обновлений Telegram на Redis Streams для горизонтального масштабирования.
+Ingress принимает webhook от Telegram и сразу складывает обновление в поток шарда
+пользователя (user_id % REDIS_SHARDS), воркер шарда читает свой поток через группу
+потребителей и обрабатывает обновления. Все обновления одного пользователя обрабатывает
+один воркер, поэтому его документы, история диалога и кэши не расходятся между процессами.
+"""
+
+import json
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+def shard_stream(shard: int) -> str:
+    """
+    Возвращает имя Redis Stream шарда.
+    
+    Args:
+        shard: Номер шарда
+        
+    Returns:
+        Имя потока
+    """
+    return f"{config.REDIS_STREAM}:{shard}"
+
+
+def shard_for_update(payload: Dict[str, Any]) -> int:
+    """
+    Определяет шард обновления по ID пользователя (или чата, если отправителя нет).
+    Обновление разбирается только как JSON, объект Update не создается.
+    
+    Args:
+        payload: Обновление Telegram в виде словаря
+        
+    Returns:
+        Номер шарда
+    """
+    for key, value in payload.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("chat") or {}
+        if "id" in sender:
+            return int(sender["id"]) % config.REDIS_SHARDS
+    return 0
+
+
+def create_ingress_app(allowed_updates: List[str]) -> FastAPI:
+    """
+    Создает HTTP приложение, принимающее webhook от Telegram.
+    Обновление без разбора кладется в Redis Stream, ответ 200 отдается сразу.
+    
+    Args:
+        allowed_updates: Типы обновлений, которые Telegram должен присылать
+        
+    Returns:
+        Приложение FastAPI
+    """
+    redis = Redis.from_url(config.REDIS_URL)
+    bot = Bot(config.TELEGRAM_BOT_TOKEN)
+    
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Регистрируем webhook при старте
+        async with bot:
+            await bot.set_webhook(
+                url=f"{config.WEBHOOK_URL}/tg/{config.WEBHOOK_SECRET}",
+                allowed_updates=allowed_updates,
+                drop_pending_updates=True,
+                secret_token=config.WEBHOOK_SECRET
+            )
+            logger.info(f"🌐 Webhook зарегистрирован: {config.WEBHOOK_URL}/tg/<secret>")
+        yield
+        await redis.aclose()
+    
+    app = FastAPI(lifespan=lifespan)
+    
+    @app.post("/tg/{secret}")
+    async def telegram_update(secret: str, request: Request) -> Response:
+        """Принимает обновление от Telegram и добавляет его в Redis Stream."""
+        if (
+            secret != config.WEBHOOK_SECRET
+            or request.headers.get("X-Telegram-Bot-Api-Secret-Token") != config.WEBHOOK_SECRET
+        ):
+            return Response(status_code=403)
+        
+        raw = await request.body()
+        try:
+            shard = shard_for_update(json.loads(raw))
+        except (ValueError, AttributeError):
+            # Некорректный JSON - отдаем в шард 0, воркер подтвердит и пропустит запись
+            shard = 0
+        await redis.xadd(
+            shard_stream(shard),
+            {"json": raw},
+            maxlen=config.REDIS_STREAM_MAXLEN,
+            approximate=True
+        )
+        return Response(status_code=200)
+    
+    return app
+
+
+def run_ingress(allowed_updates: List[str]) -> None:
+    """
+    Запускает ingress сервер (блокирующий вызов).
+    
+    Args:
+        allowed_updates: Типы обновлений, которые Telegram должен присылать
+    """
+    uvicorn.run(
+        create_ingress_app(allowed_updates),
+        host=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        log_level="warning"
+    )
+
+
+async def _process_entry(application: Application, redis: Redis, entry_id: str, fields: Dict[str, str]) -> None:
+    """
+    Обрабатывает одну запись потока и подтверждает ее (XACK) после обработки.
+    Если воркер упадет до подтверждения, запись останется в pending и будет обработана повторно.
+    
+    Args:
+        application: Приложение Telegram (без Updater)
+        redis: Клиент Redis
+        entry_id: ID записи в потоке
+        fields: Поля записи
+    """
+    try:
+        update = Update.de_json(json.loads(fields["json"]), application.bot)
+    except Exception as e:
+        # Некорректную (или уже удаленную из потока) запись повторять бессмысленно
+        logger.error(f"Не удалось разобрать обновление {entry_id}: {e}")
+        await redis.xack(shard_stream(config.WORKER_SHARD), config.REDIS_GROUP, entry_id)
+        return
+    
+    await application.process_update(update)
+    await redis.xack(shard_stream(config.WORKER_SHARD), config.REDIS_GROUP, entry_id)
+
+
+async def _claim_stale_entries(redis: Redis, stream: str) -> List[Tuple[str, Optional[Dict[str, str]]]]:
+    """
+    Забирает себе записи, которые другие потребители получили, но давно не подтвердили
+    (воркер упал или был перезапущен с другим WORKER_ID).
+    
+    Args:
+        redis: Клиент Redis
+        stream: Имя потока
+        
+    Returns:
+        Список записей (ID, поля)
+    """
+    claimed = []
+    start_id = "0-0"
+    while True:
+        response = await redis.xautoclaim(
+            stream,
+            config.REDIS_GROUP,
+            config.WORKER_ID,
+            min_idle_time=config.CLAIM_MIN_IDLE_MS,
+            start_id=start_id,
+            count=config.UPDATE_BATCH_SIZE
+        )
+        start_id, entries = response[0], response[1]
+        claimed.extend(entries)
+        if start_id == "0-0":
+            break
+    
+    # Удаляем из группы потребителей прежних процессов, у которых не осталось записей
+    for consumer in await redis.xinfo_consumers(stream, config.REDIS_GROUP):
+        if (
+            consumer["name"] != config.WORKER_ID
+            and consumer["pending"] == 0
+            and consumer["idle"] > config.CLAIM_MIN_IDLE_MS
+        ):
+            await redis.xgroup_delconsumer(stream, config.REDIS_GROUP, consumer["name"])
+    
+    return claimed
+
+
+async def run_worker(application: Application, rag_bot) -> None:
+    """
+    Читает обновления из Redis Stream и обрабатывает их через обработчики приложения.
+    
+    Args:
+        application: Приложение Telegram, собранное без Updater
+        rag_bot: Экземпляр RAGBot (для инициализации и освобождения ресурсов)
+    """
+    stream = shard_stream(config.WORKER_SHARD)
+    redis = Redis.from_url(config.REDIS_URL, decode_responses=True)
+    try:
+        await redis.xgroup_create(stream, config.REDIS_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    
+    # Каждая запись обрабатывается отдельной задачей: долгая загрузка документа не мешает
+    # читать поток дальше. Семафор ограничивает количество одновременно обрабатываемых записей
+    semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_UPDATES)
+    in_flight: Dict[str, asyncio.Task] = {}
+    
+    async def run_entry(entry_id: str, fields: Optional[Dict[str, str]]) -> None:
+        try:
+            await _process_entry(application, redis, entry_id, fields)
+        except Exception as e:
+            # Запись не подтверждена и будет повторно забрана через XAUTOCLAIM
+            logger.error(f"Ошибка при обработке обновления {entry_id}: {e}", exc_info=True)
+        finally:
+            semaphore.release()
+    
+    async def start_entry(entry_id: str, fields: Optional[Dict[str, str]]) -> None:
+        # Запись, которая уже обрабатывается этим воркером, повторно не запускаем
+        if entry_id in in_flight:
+            return
+        await semaphore.acquire()
+        task = asyncio.create_task(run_entry(entry_id, fields))
+        in_flight[entry_id] = task
+        task.add_done_callback(lambda _: in_flight.pop(entry_id, None))
+    
+    async with application:
+        await rag_bot.post_init(application)
+        await application.start()
+        logger.info(f"👷 Воркер {config.WORKER_ID} читает поток {stream}")
+        try:
+            next_claim = 0.0
+            while True:
+                # Периодически забираем зависшие записи упавших воркеров
+                if time.monotonic() >= next_claim:
+                    next_claim = time.monotonic() + config.CLAIM_INTERVAL
+                    stale = await _claim_stale_entries(redis, stream)
+                    if stale:
+                        logger.warning(f"Забрано {len(stale)} неподтвержденных обновлений других воркеров")
+                    for entry_id, fields in stale:
+                        await start_entry(entry_id, fields)
+                
+                # Читаем новые записи, только когда есть свободный слот
+                async with semaphore:
+                    pass
+                
+                response = await redis.xreadgroup(
+                    config.REDIS_GROUP,
+                    config.WORKER_ID,
+                    {stream: ">"},
+                    count=config.UPDATE_BATCH_SIZE,
+                    block=1000
+                )
+                entries = response[0][1] if response else []
+                for entry_id, fields in entries:
+                    await start_entry(entry_id, fields)
+        finally:
+            # Незавершенные записи остаются неподтвержденными и будут забраны другим процессом
+            for task in list(in_flight.values()):
+                task.cancel()
+            await asyncio.gather(*in_flight.values(), return_exceptions=True)
+            await application.stop()
+            await rag_bot.shutdown(application)
+            await redis.aclose()
@@ -5,9 +5,281 @@
 
 import chromadb
 from chromadb.config import Settings
-from typing import List, Dict, Optional
+from typing import Callable, Iterable, List, Dict, Optional, Tuple, Union
+from functools import cache, lru_cache
+from collections import OrderedDict
 from sentence_transformers import SentenceTransformer
-import uuid
+import numpy as np
+import torch
+import threading
+import queue
+import hashlib
+import logging
+import os
+import time
+import itertools
+
+from .disk_cache import clear_user_cache, open_cache_file, touch, user_cache_dir
+
+# Опциональный бэкенд: квантованная int8 модель через ONNX Runtime
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+except ImportError:
+    ORTModelForFeatureExtraction = None
+
+logger = logging.getLogger(__name__)
+
+# BLAKE3 (SIMD) для хэширования чанков, если установлен
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+# Имя файла, который ORTQuantizer создает в директории модели
+ONNX_QUANTIZED_FILE = "model_quantized.onnx"
+
+# Максимальная длина входа модели в токенах (ограничивает паддинг в батче)
+MAX_SEQ_LENGTH = 256
+
+# Сколько коллекций пользователей держится открытыми (давно не использованные вытесняются)
+MAX_CACHED_COLLECTIONS = 1024
+
+# Параметры HNSW индекса для новых коллекций пользователей.
+# Эмбеддинги нормализованы, поэтому скалярное произведение ("ip") ранжирует так же, как косинус,
+# но без нормировки при каждом вычислении расстояния
+HNSW_METADATA = {
+    "hnsw:space": "ip",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+    "hnsw:search_ef": 64,
+}
+
+
+def quantize_embedding_model(embedding_model: str, save_dir: str) -> None:
+    """
+    Экспортирует модель эмбеддингов в ONNX и квантует веса в int8 (динамическая квантизация).
+    Выполняется один раз, результат указывается в EMBEDDING_ONNX_PATH.
+    
+    Args:
+        embedding_model: Название модели Sentence Transformers
+        save_dir: Директория для сохранения квантованной модели
+    """
+    if ORTModelForFeatureExtraction is None:
+        raise ImportError("optimum не установлен. Установите: pip install optimum[onnxruntime]")
+    
+    model = ORTModelForFeatureExtraction.from_pretrained(embedding_model, export=True)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantizer.quantize(
+        save_dir=save_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    )
+    AutoTokenizer.from_pretrained(embedding_model).save_pretrained(save_dir)
+
+
+class OnnxEmbedder:
+    """
+    Модель эмбеддингов на ONNX Runtime (int8).
+    Повторяет интерфейс SentenceTransformer.encode, который использует VectorStore.
+    """
+    
+    def __init__(self, model_path: str, max_seq_length: int = MAX_SEQ_LENGTH):
+        """
+        Загрузка квантованной модели.
+        
+        Args:
+            model_path: Директория с квантованной ONNX моделью и токенизатором
+            max_seq_length: Максимальная длина входа в токенах
+        """
+        if ORTModelForFeatureExtraction is None:
+            raise ImportError("optimum не установлен. Установите: pip install optimum[onnxruntime]")
+        
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_path,
+            file_name=ONNX_QUANTIZED_FILE,
+            provider="CPUExecutionProvider"
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.max_seq_length = max_seq_length
+    
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+        show_progress_bar: bool = False
+    ) -> np.ndarray:
+        """
+        Создает эмбеддинги: mean pooling по токенам и (опционально) L2-нормализация.
+        
+        Args:
+            sentences: Текст или список текстов
+            batch_size: Размер батча
+            convert_to_numpy: Оставлен для совместимости, результат всегда numpy
+            normalize_embeddings: Нормализовать ли эмбеддинги
+            show_progress_bar: Оставлен для совместимости
+            
+        Returns:
+            Массив эмбеддингов (одномерный для одной строки)
+        """
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        
+        batches = []
+        for i in range(0, len(sentences), batch_size):
+            inputs = self.tokenizer(
+                sentences[i:i + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            outputs = self.model(**inputs)
+            # Mean pooling с учетом маски и нормализация одним шагом NumPy
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (outputs.last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled)
+        
+        embeddings = np.concatenate(batches) if batches else np.empty((0, 0), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+
+def content_hash(text: str) -> str:
+    """
+    Вычисляет хэш содержимого чанка (BLAKE3, либо BLAKE2b, если blake3 не установлен).
+    
+    Args:
+        text: Текст чанка
+        
+    Returns:
+        Хэш в шестнадцатеричном виде
+    """
+    data = text.encode("utf-8")
+    if blake3 is not None:
+        return blake3(data).hexdigest()
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+# Блокировка, чтобы модель не загружалась дважды при одновременном первом обращении из разных потоков
+_embedder_lock = threading.Lock()
+
+
+@cache
+def _load_embedder(embedding_model: str, onnx_model_path: Optional[str] = None):
+    """
+    Загружает модель эмбеддингов. Результат кэшируется: в процессе живет
+    одна копия весов, общая для всех экземпляров VectorStore и потоков.
+    
+    Args:
+        embedding_model: Название модели Sentence Transformers
+        onnx_model_path: Директория с квантованной ONNX моделью (если None - используется PyTorch)
+        
+    Returns:
+        Модель с методом encode
+    """
+    if onnx_model_path:
+        logger.info(f"Загрузка квантованной ONNX модели эмбеддингов: {onnx_model_path}...")
+        model = OnnxEmbedder(onnx_model_path)
+    else:
+        if torch.cuda.is_available():
+            # На GPU загружаем веса сразу в bfloat16: быстрее и вдвое меньше памяти
+            logger.info(f"Загрузка модели эмбеддингов: {embedding_model} (CUDA, bfloat16)...")
+            model = SentenceTransformer(
+                embedding_model,
+                device="cuda",
+                model_kwargs={"torch_dtype": torch.bfloat16}
+            )
+        else:
+            logger.info(f"Загрузка модели эмбеддингов: {embedding_model} (CPU)...")
+            # Внутриоперационный параллелизм на все ядра; межоперационный - один поток,
+            # чтобы два уровня пулов не конкурировали за ядра
+            torch.set_num_threads(os.cpu_count() or 1)
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                # Задается только до первой параллельной операции PyTorch в процессе
+                pass
+            model = SentenceTransformer(embedding_model, device="cpu")
+        model.max_seq_length = MAX_SEQ_LENGTH
+    
+    # Прогрев: первый вызов encode инициализирует ядра и аллокаторы,
+    # без прогрева эта задержка достается первому запросу пользователя
+    model.encode(["warmup"] * 2, batch_size=2, show_progress_bar=False)
+    logger.info("Модель загружена!")
+    return model
+
+
+def get_embedder(embedding_model: str, onnx_model_path: Optional[str] = None):
+    """
+    Возвращает общую (singleton) модель эмбеддингов, загружая ее при первом обращении.
+    
+    Args:
+        embedding_model: Название модели Sentence Transformers
+        onnx_model_path: Директория с квантованной ONNX моделью (если None - используется PyTorch)
+        
+    Returns:
+        Модель с методом encode
+    """
+    with _embedder_lock:
+        return _load_embedder(embedding_model, onnx_model_path)
+
+
+class _ChunkWriter:
+    """
+    Фоновый поток записи чанков в ChromaDB.
+    Пока поток пишет очередной блок, вызывающий поток уже считает эмбеддинги следующего.
+    Очередь ограничена, поэтому в памяти не накапливается больше maxsize готовых блоков.
+    """
+    
+    def __init__(self, write: Callable, maxsize: int = 2):
+        """
+        Запуск потока записи.
+        
+        Args:
+            write: Функция записи одного блока (вызывается с аргументами из put)
+            maxsize: Максимальное количество блоков в очереди
+        """
+        self._write = write
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=maxsize)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="chroma-writer", daemon=True)
+        self._thread.start()
+    
+    def put(self, *args) -> None:
+        """
+        Ставит блок в очередь на запись (ждет, если очередь заполнена).
+        
+        Args:
+            *args: Аргументы функции записи
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put(args)
+    
+    def close(self) -> None:
+        """Дожидается записи всех блоков и пробрасывает ошибку записи, если она была."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+    
+    def _run(self) -> None:
+        """Цикл потока: записывает блоки, пока не получит None."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            # После ошибки продолжаем разбирать очередь, чтобы не заблокировать put
+            if self._error is None:
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    self._error = e
 
 
 class VectorStore:
@@ -16,21 +288,34 @@ class VectorStore:
     Создает и хранит эмбеддинги документов, выполняет поиск.
     """
     
-    def __init__(self, db_path: str = "./chroma_db", embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"):
+    def __init__(
+        self,
+        db_path: str = "./chroma_db",
+        embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
+        batch_size: int = 64,
+        onnx_model_path: Optional[str] = None,
+        ingest_batch_size: int = 256,
+        cache_dir: Optional[str] = None
+    ):
         """
         Инициализация векторного хранилища.
         
         Args:
             db_path: Путь к директории базы данных ChromaDB
             embedding_model: Название модели для создания эмбеддингов
+            batch_size: Размер батча при создании эмбеддингов
+            onnx_model_path: Директория с квантованной ONNX моделью (если None - используется PyTorch)
+            ingest_batch_size: Сколько чанков документа обрабатывается за раз при потоковой загрузке
+            cache_dir: Директория дискового кэша эмбеддингов документов (по умолчанию db_path/cache)
         """
         self.db_path = db_path
         self.embedding_model_name = embedding_model
+        self.onnx_model_path = onnx_model_path
+        self.batch_size = batch_size
+        self.ingest_batch_size = ingest_batch_size
         
-        # Инициализируем модель для эмбеддингов
-        print(f"Загрузка модели эмбеддингов: {embedding_model}...")
-        self.embedding_model = SentenceTransformer(embedding_model)
-        print("Модель загружена!")
+        # Модель эмбеддингов загружается лениво при первом обращении (см. embedding_model)
+        self._embedding_model = None
         
         # Инициализируем клиент ChromaDB
         self.client = chromadb.PersistentClient(
@@ -38,9 +323,65 @@ class VectorStore:
             settings=Settings(anonymized_telemetry=False)
         )
         
-        # Словарь для хранения коллекций по пользователям
-        # Каждый пользователь имеет свою коллекцию
-        self.collections: Dict[int, chromadb.Collection] = {}
+        # Кэш эмбеддингов по пользователю и хэшу содержимого чанка: повторно загруженные
+        # документы не пересчитываются моделью. Кэш свой для каждой модели.
+        # Хранятся только хэши и векторы, текст чанков пользователей в кэш не попадает.
+        # Записи пользователя удаляются по /clear, старые - в prune_embedding_cache
+        model_key = f"{embedding_model}|{onnx_model_path or ''}"
+        self._model_tag = hashlib.blake2b(model_key.encode('utf-8'), digest_size=6).hexdigest()
+        self.embedding_cache = self.client.get_or_create_collection(
+            name=f"embeddings_{self._model_tag}",
+            metadata={"embedding_model": model_key}
+        )
+        
+        # Дисковый кэш эмбеддингов целых документов по SHA-256 файла, по поддиректории на пользователя
+        self.cache_dir = cache_dir or os.path.join(db_path, "cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        
+        # Коллекции по пользователям (каждый пользователь имеет свою коллекцию).
+        # LRU на MAX_CACHED_COLLECTIONS записей; обращения идут из разных потоков, поэтому под блокировкой
+        self.collections: "OrderedDict[int, chromadb.Collection]" = OrderedDict()
+        self._collections_lock = threading.Lock()
+        self._load_user_collections()
+        
+        # LRU кэши для повторяющихся вопросов: эмбеддинг запроса
+        # и найденные чанки по ключу (user_id, запрос, n_results)
+        self._embed_query_cached = lru_cache(maxsize=2048)(self._embed_query)
+        self._search_cached = lru_cache(maxsize=512)(self._search_uncached)
+    
+    @property
+    def embedding_model(self):
+        """Модель эмбеддингов (общая для процесса, загружается при первом обращении)."""
+        if self._embedding_model is None:
+            self._embedding_model = get_embedder(self.embedding_model_name, self.onnx_model_path)
+        return self._embedding_model
+    
+    def load_embedding_model(self) -> None:
+        """
+        Заранее загружает модель эмбеддингов, чтобы первый запрос пользователя не ждал загрузки.
+        Блокирующий вызов: из асинхронного кода запускается через asyncio.to_thread.
+        """
+        _ = self.embedding_model
+    
+    def _load_user_collections(self) -> None:
+        """
+        Заполняет self.collections коллекциями пользователей, уже существующими в базе,
+        чтобы после перезапуска первый запрос пользователя не обращался к ChromaDB за коллекцией.
+        """
+        for entry in self.client.list_collections():
+            if len(self.collections) >= MAX_CACHED_COLLECTIONS:
+                break
+            # ChromaDB 0.6 возвращает имена коллекций, остальные версии - объекты Collection
+            name = entry if isinstance(entry, str) else entry.name
+            if not name.startswith("user_"):
+                continue
+            try:
+                user_id = int(name[len("user_"):])
+            except ValueError:
+                continue
+            self.collections[user_id] = self.client.get_collection(name=name) if isinstance(entry, str) else entry
+        
+        logger.info(f"Загружено коллекций пользователей: {len(self.collections)}")
     
     def get_or_create_collection(self, user_id: int) -> chromadb.Collection:
         """
@@ -52,22 +393,32 @@ class VectorStore:
         Returns:
             Коллекция ChromaDB для пользователя
         """
-        if user_id not in self.collections:
-            collection_name = f"user_{user_id}"
-            try:
-                # Пытаемся получить существующую коллекцию
-                collection = self.client.get_collection(name=collection_name)
-            except:
-                # Если коллекции нет, создаем новую
-                collection = self.client.create_collection(
-                    name=collection_name,
-                    metadata={"user_id": user_id}
-                )
+        with self._collections_lock:
+            collection = self.collections.get(user_id)
+            if collection is not None:
+                self.collections.move_to_end(user_id)
+                return collection
+            
+            # Параметры HNSW применяются только при создании коллекции,
+            # у существующей коллекции ChromaDB их не меняет
+            collection = self.client.get_or_create_collection(
+                name=f"user_{user_id}",
+                metadata={"user_id": user_id, **HNSW_METADATA}
+            )
             self.collections[user_id] = collection
-        
-        return self.collections[user_id]
+            if len(self.collections) > MAX_CACHED_COLLECTIONS:
+                # Вытесняем коллекцию, к которой дольше всего не обращались
+                self.collections.popitem(last=False)
+            return collection
     
-    def add_documents(self, user_id: int, chunks: List[str], metadatas: Optional[List[Dict]] = None) -> None:
+    def add_documents(
+        self,
+        user_id: int,
+        chunks: List[str],
+        metadatas: Optional[List[Dict]] = None,
+        doc_hash: Optional[str] = None,
+        start_index: int = 0
+    ) -> None:
         """
         Добавляет документы (чанки) в векторную базу данных.
         
@@ -75,36 +426,325 @@ class VectorStore:
             user_id: ID пользователя Telegram
             chunks: Список текстовых чанков для добавления
             metadatas: Опциональные метаданные для каждого чанка
+            doc_hash: SHA-256 исходного файла; если задан, эмбеддинги документа кэшируются на диске
+            start_index: Позиция первого чанка в документе (при добавлении документа минибатчами)
         """
+        # Подготавливаем метаданные, если они не предоставлены
+        if metadatas is None:
+            metadatas = [{"chunk_index": i} for i in range(start_index, start_index + len(chunks))]
+        
+        # Пустые чанки не кодируем: они только занимают место в батче модели
+        keep = [i for i, chunk in enumerate(chunks) if chunk.strip()]
+        if len(keep) < len(chunks):
+            chunks = [chunks[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+        
         if not chunks:
             return
         
         collection = self.get_or_create_collection(user_id)
         
-        # Создаем эмбеддинги для всех чанков
-        print(f"Создание эмбеддингов для {len(chunks)} чанков...")
-        embeddings = self.embedding_model.encode(chunks, show_progress_bar=True).tolist()
+        hashes = [content_hash(chunk) for chunk in chunks]
+        ids = self._chunk_ids(user_id, hashes, start=start_index)
         
-        # Генерируем уникальные ID для каждого чанка
-        ids = [str(uuid.uuid4()) for _ in chunks]
+        # Считаем эмбеддинги минибатчами, запись в ChromaDB идет параллельно в отдельном потоке
+        writer = _ChunkWriter(self._add_chunks)
+        try:
+            for i in range(0, len(chunks), self.ingest_batch_size):
+                batch = slice(i, i + self.ingest_batch_size)
+                cache_key = f"{doc_hash}_{start_index + i}" if doc_hash is not None else None
+                embeddings = self._document_embeddings(user_id, chunks[batch], hashes[batch], cache_key)
+                writer.put(collection, chunks[batch], ids[batch], metadatas[batch], embeddings)
+        finally:
+            writer.close()
+        
+        # Результаты поиска для пользователя устарели
+        self._search_cached.cache_clear()
+        
+        logger.info(f"Добавлено {len(chunks)} чанков в базу данных для пользователя {user_id}")
+    
+    def replace_documents(
+        self,
+        user_id: int,
+        chunks: Iterable[str],
+        metadatas: Optional[Iterable[Dict]] = None,
+        doc_hash: Optional[str] = None
+    ) -> int:
+        """
+        Заменяет документы пользователя новыми, не пересоздавая коллекцию.
+        Чанки, которые уже есть в коллекции (совпадает ID), повторно в индекс не вставляются,
+        устаревшие чанки удаляются по ID.
+        Чанки могут поступать потоком (например, из DocumentProcessor.split_stream):
+        они обрабатываются минибатчами по ingest_batch_size, весь документ в памяти не хранится.
+        Если поток прерывается ошибкой (например, битая страница PDF), вставленные чанки
+        удаляются, и в коллекции остается старый документ без изменений.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            chunks: Текстовые чанки нового документа (список или итератор)
+            metadatas: Опциональные метаданные для каждого чанка (список или итератор)
+            doc_hash: SHA-256 исходного файла; если задан, эмбеддинги документа кэшируются на диске
+            
+        Returns:
+            Количество чанков документа
+        """
+        collection = self.get_or_create_collection(user_id)
         
         # Подготавливаем метаданные, если они не предоставлены
         if metadatas is None:
-            metadatas = [{"chunk_index": i} for i in range(len(chunks))]
+            metadatas = ({"chunk_index": i} for i in itertools.count())
+        
+        # ID, которые уже лежат в коллекции: с ними сравнивается каждый минибатч
+        existing_ids = set(collection.get(include=[])["ids"])
+        seen_ids = set()
+        inserted_ids = []
+        # Метаданные совпадающих чанков обновляются только после успешной загрузки всего документа
+        kept_ids = []
+        kept_metadatas = []
+        total = 0
+        
+        # Пустые чанки пропускаем, метаданные отбрасываются вместе с ними
+        pairs = ((chunk, metadata) for chunk, metadata in zip(chunks, metadatas) if chunk.strip())
+        # Эмбеддинги следующего минибатча считаются, пока предыдущий записывается в ChromaDB
+        writer = _ChunkWriter(self._add_chunks)
+        try:
+            try:
+                while batch := list(itertools.islice(pairs, self.ingest_batch_size)):
+                    batch_chunks = [chunk for chunk, _ in batch]
+                    batch_metadatas = [metadata for _, metadata in batch]
+                    hashes = [content_hash(chunk) for chunk in batch_chunks]
+                    ids = self._chunk_ids(user_id, hashes, start=total)
+                    
+                    for i, chunk_id in enumerate(ids):
+                        if chunk_id in existing_ids:
+                            # Содержимое совпадает, обновим только метаданные (например, имя файла)
+                            kept_ids.append(chunk_id)
+                            kept_metadatas.append(batch_metadatas[i])
+                    
+                    new = [i for i, chunk_id in enumerate(ids) if chunk_id not in existing_ids]
+                    if new:
+                        if doc_hash is not None:
+                            # Эмбеддинги минибатча целиком (из дискового кэша или с сохранением в него)
+                            embeddings = self._document_embeddings(
+                                user_id, batch_chunks, hashes, f"{doc_hash}_{total}"
+                            )[new]
+                        else:
+                            embeddings = self._embed_chunks(
+                                user_id, [batch_chunks[i] for i in new], [hashes[i] for i in new]
+                            )
+                        new_ids = [ids[i] for i in new]
+                        inserted_ids.extend(new_ids)
+                        writer.put(
+                            collection,
+                            [batch_chunks[i] for i in new],
+                            new_ids,
+                            [batch_metadatas[i] for i in new],
+                            embeddings
+                        )
+                    
+                    seen_ids.update(ids)
+                    total += len(batch)
+            finally:
+                writer.close()
+        except BaseException:
+            # Откатываем частично загруженный документ, чтобы ответы не смешивали старый и новый
+            if inserted_ids:
+                try:
+                    collection.delete(ids=inserted_ids)
+                except Exception as e:
+                    logger.error(f"Не удалось откатить загрузку документа пользователя {user_id}: {e}")
+            self._search_cached.cache_clear()
+            raise
+        
+        for i in range(0, len(kept_ids), self.ingest_batch_size):
+            collection.update(
+                ids=kept_ids[i:i + self.ingest_batch_size],
+                metadatas=kept_metadatas[i:i + self.ingest_batch_size]
+            )
+        
+        # Удаляем чанки старого документа, которых нет в новом
+        stale_ids = list(existing_ids.difference(seen_ids))
+        if stale_ids:
+            collection.delete(ids=stale_ids)
+        
+        # Результаты поиска для пользователя устарели
+        self._search_cached.cache_clear()
+        
+        logger.info(
+            f"Документы пользователя {user_id} заменены: добавлено {len(inserted_ids)}, "
+            f"без изменений {len(kept_ids)}, удалено {len(stale_ids)} чанков"
+        )
+        return total
+    
+    @staticmethod
+    def _chunk_ids(user_id: int, hashes: List[str], start: int = 0) -> List[str]:
+        """
+        Генерирует детерминированные ID по позиции и содержимому чанка.
+        Позиция идет первой и дополнена нулями: ID одного документа возрастают монотонно,
+        и вставка в индекс ID ChromaDB идет последовательно, а не в случайные места.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            hashes: Хэши содержимого чанков (content_hash)
+            start: Позиция первого чанка в документе
+            
+        Returns:
+            Список ID чанков
+        """
+        return [f"{user_id}:{i:08d}:{h[:16]}" for i, h in enumerate(hashes, start)]
+    
+    def _add_chunks(
+        self,
+        collection: chromadb.Collection,
+        chunks: List[str],
+        ids: List[str],
+        metadatas: List[Dict],
+        embeddings: np.ndarray
+    ) -> None:
+        """
+        Добавляет чанки с готовыми эмбеддингами в коллекцию одним вызовом add.
+        Размер блока (одной транзакции) задает вызывающий код: минибатч по ingest_batch_size.
         
-        # Добавляем документы в коллекцию
+        Args:
+            collection: Коллекция ChromaDB
+            chunks: Список текстовых чанков
+            ids: ID чанков
+            metadatas: Метаданные для каждого чанка
+            embeddings: Эмбеддинги чанков
+        """
+        # Эмбеддинги передаются массивом NumPy, без преобразования в списки Python
         collection.add(
-            embeddings=embeddings,
+            embeddings=embeddings.astype(np.float32, copy=False),
             documents=chunks,
             metadatas=metadatas,
             ids=ids
         )
+    
+    def _document_embeddings(
+        self,
+        user_id: int,
+        chunks: List[str],
+        hashes: List[str],
+        doc_hash: Optional[str]
+    ) -> np.ndarray:
+        """
+        Возвращает эмбеддинги чанков документа. Если задан ключ (хэш файла, для минибатча -
+        с позицией первого чанка), эмбеддинги берутся из cache/{user_id}/{doc_hash}_{модель}.npz,
+        а при промахе вычисляются и сохраняются туда.
+        Эмбеддинги хранятся в float32 без потерь: они попадают в индекс поиска.
+        Вместе с ними хранятся только хэши чанков, текст документа в этот файл не пишется.
+        
+        Args:
+            user_id: ID пользователя Telegram, в чей кэш сохраняются эмбеддинги
+            chunks: Список текстовых чанков
+            hashes: Хэши содержимого чанков (content_hash)
+            doc_hash: Ключ кэша на основе SHA-256 исходного файла (если None - без дискового кэша)
+            
+        Returns:
+            Массив эмбеддингов в порядке чанков
+        """
+        if doc_hash is None:
+            return self._embed_chunks(user_id, chunks, hashes)
+        
+        cache_path = os.path.join(user_cache_dir(self.cache_dir, user_id), f"{doc_hash}_{self._model_tag}.npz")
+        if os.path.exists(cache_path):
+            try:
+                with np.load(cache_path, allow_pickle=False) as data:
+                    # Чанки сверяем по хэшам: при другом CHUNK_SIZE тот же файл режется иначе
+                    if data["hashes"].tolist() == hashes:
+                        logger.info(f"Эмбеддинги документа {doc_hash[:12]} взяты из кэша")
+                        touch(cache_path)
+                        return data["embeddings"]
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать кэш эмбеддингов {cache_path}: {e}")
+        
+        embeddings = self._embed_chunks(user_id, chunks, hashes)
         
-        print(f"Добавлено {len(chunks)} чанков в базу данных для пользователя {user_id}")
+        # Пишем во временный файл и атомарно переименовываем
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open_cache_file(tmp_path, "wb") as f:
+            np.savez(f, embeddings=embeddings, hashes=np.array(hashes))
+        os.replace(tmp_path, cache_path)
+        return embeddings
+    
+    def _embed_chunks(self, user_id: int, chunks: List[str], hashes: List[str]) -> np.ndarray:
+        """
+        Создает эмбеддинги чанков, пропуская чанки, которые уже есть в кэше эмбеддингов пользователя.
+        Моделью кодируются только новые (уникальные) чанки, они же добавляются в кэш.
+        
+        Args:
+            user_id: ID пользователя Telegram, в чей кэш сохраняются эмбеддинги
+            chunks: Список текстовых чанков
+            hashes: Хэши содержимого чанков (content_hash)
+            
+        Returns:
+            Массив эмбеддингов в порядке чанков
+        """
+        # Первое вхождение каждого уникального чанка
+        first_index: Dict[str, int] = {}
+        for i, h in enumerate(hashes):
+            first_index.setdefault(h, i)
+        
+        prefix = f"{user_id}:"
+        cached = self.embedding_cache.get(ids=[prefix + h for h in first_index], include=["embeddings"])
+        known = {
+            cache_id[len(prefix):]: embedding
+            for cache_id, embedding in zip(cached["ids"], cached["embeddings"])
+        }
+        
+        missing = [h for h in first_index if h not in known]
+        if missing:
+            missing_chunks = [chunks[first_index[h]] for h in missing]
+            logger.info(f"Создание эмбеддингов для {len(missing)} новых чанков из {len(chunks)}...")
+            # Кодируем чанки в порядке длины: в батч попадают тексты близкой длины и
+            # паддинг минимален (SentenceTransformer делает это сам, OnnxEmbedder - нет).
+            # Затем возвращаем эмбеддинги в исходный порядок
+            order = np.argsort([len(chunk) for chunk in missing_chunks], kind="stable")
+            encoded = self.embedding_model.encode(
+                [missing_chunks[i] for i in order],
+                batch_size=self.batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+            new_embeddings = np.empty_like(encoded, dtype=np.float32)
+            new_embeddings[order] = encoded
+            # Вызывается на минибатч документа, поэтому запись в кэш - тоже один вызов
+            cache_metadata = {"user_id": user_id, "created_at": int(time.time())}
+            self.embedding_cache.upsert(
+                ids=[prefix + h for h in missing],
+                embeddings=new_embeddings,
+                metadatas=[cache_metadata] * len(missing)
+            )
+            known.update(zip(missing, new_embeddings))
+        
+        return np.asarray([known[h] for h in hashes], dtype=np.float32)
+    
+    def _embed_query(self, query: str) -> np.ndarray:
+        """
+        Создает эмбеддинг запроса (результат кэшируется в _embed_query_cached).
+        Эмбеддинг хранится в float16: кэш занимает вдвое меньше памяти,
+        а на качество ранжирования нормализованных векторов это не влияет.
+        
+        Args:
+            query: Текстовый запрос
+            
+        Returns:
+            Эмбеддинг запроса (float16, только для чтения)
+        """
+        embedding = self.embedding_model.encode(
+            query,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        ).astype(np.float16)
+        embedding.flags.writeable = False
+        return embedding
     
     def search(self, user_id: int, query: str, n_results: int = 3) -> List[Dict]:
         """
         Выполняет семантический поиск релевантных чанков по запросу.
+        Повторные запросы отдаются из LRU кэша без обращения к модели и ChromaDB.
         
         Args:
             user_id: ID пользователя Telegram
@@ -114,44 +754,125 @@ class VectorStore:
         Returns:
             Список словарей с найденными чанками и их метаданными
         """
+        return list(self._search_cached(user_id, query, n_results))
+    
+    def _search_uncached(self, user_id: int, query: str, n_results: int) -> Tuple[Dict, ...]:
+        """
+        Выполняет поиск в коллекции пользователя без кэша результатов.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            query: Текстовый запрос для поиска
+            n_results: Количество результатов для возврата
+            
+        Returns:
+            Кортеж словарей с найденными чанками и их метаданными
+        """
         collection = self.get_or_create_collection(user_id)
         
-        # Создаем эмбеддинг для запроса
-        query_embedding = self.embedding_model.encode([query]).tolist()[0]
+        # Создаем эмбеддинг для запроса (или берем из кэша)
+        query_embedding = self._embed_query_cached(query).astype(np.float32)
         
         # Выполняем поиск в коллекции
         results = collection.query(
-            query_embeddings=[query_embedding],
+            query_embeddings=query_embedding.reshape(1, -1),
+            n_results=n_results
+        )
+        
+        return tuple(self._format_results(results, 0))
+    
+    def search_batch(self, user_id: int, queries: List[str], n_results: int = 3) -> List[List[Dict]]:
+        """
+        Выполняет семантический поиск сразу по нескольким запросам:
+        эмбеддинги всех запросов создаются одним батчем, поиск - одним запросом к ChromaDB.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            queries: Список текстовых запросов
+            n_results: Количество результатов для каждого запроса
+            
+        Returns:
+            Для каждого запроса - список словарей с найденными чанками и их метаданными
+        """
+        if not queries:
+            return []
+        
+        collection = self.get_or_create_collection(user_id)
+        
+        query_embeddings = self.embedding_model.encode(
+            queries,
+            batch_size=32,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        ).astype(np.float32, copy=False)
+        
+        results = collection.query(
+            query_embeddings=query_embeddings,
             n_results=n_results
         )
         
-        # Форматируем результаты
+        return [self._format_results(results, i) for i in range(len(queries))]
+    
+    @staticmethod
+    def _format_results(results: Dict, query_index: int) -> List[Dict]:
+        """
+        Преобразует ответ collection.query для одного запроса в список словарей.
+        
+        Args:
+            results: Результат collection.query
+            query_index: Номер запроса в батче
+            
+        Returns:
+            Список словарей с найденными чанками и их метаданными
+        """
         formatted_results = []
-        if results['documents'] and len(results['documents'][0]) > 0:
-            for i in range(len(results['documents'][0])):
+        if results['documents'] and len(results['documents'][query_index]) > 0:
+            documents = results['documents'][query_index]
+            for i in range(len(documents)):
                 formatted_results.append({
-                    'document': results['documents'][0][i],
-                    'metadata': results['metadatas'][0][i] if results['metadatas'] else {},
-                    'distance': results['distances'][0][i] if results['distances'] else None
+                    'document': documents[i],
+                    'metadata': results['metadatas'][query_index][i] if results['metadatas'] else {},
+                    'distance': results['distances'][query_index][i] if results['distances'] else None
                 })
         
         return formatted_results
     
     def clear_user_collection(self, user_id: int) -> None:
         """
-        Очищает коллекцию документов пользователя.
+        Очищает коллекцию документов пользователя, его кэш эмбеддингов и дисковый кэш документов.
         
         Args:
             user_id: ID пользователя Telegram
         """
         collection_name = f"user_{user_id}"
+        # Сбрасываем кэш результатов поиска, чтобы не отдавать удаленные чанки
+        self._search_cached.cache_clear()
         try:
             self.client.delete_collection(name=collection_name)
-            if user_id in self.collections:
-                del self.collections[user_id]
-            print(f"Коллекция пользователя {user_id} очищена")
+            with self._collections_lock:
+                self.collections.pop(user_id, None)
+            logger.info(f"Коллекция пользователя {user_id} очищена")
+        except Exception as e:
+            logger.error(f"Ошибка при очистке коллекции: {e}")
+        try:
+            self.embedding_cache.delete(where={"user_id": user_id})
+        except Exception as e:
+            logger.error(f"Ошибка при очистке кэша эмбеддингов: {e}")
+        clear_user_cache(self.cache_dir, user_id)
+    
+    def prune_embedding_cache(self, max_age_seconds: float) -> None:
+        """
+        Удаляет из кэша эмбеддингов записи, созданные больше max_age_seconds назад.
+        
+        Args:
+            max_age_seconds: Максимальный возраст записи в секундах
+        """
+        cutoff = int(time.time() - max_age_seconds)
+        try:
+            self.embedding_cache.delete(where={"created_at": {"$lt": cutoff}})
         except Exception as e:
-            print(f"Ошибка при очистке коллекции: {e}")
+            logger.error(f"Ошибка при очистке кэша эмбеддингов: {e}")
     
     def get_collection_count(self, user_id: int) -> int:
         """